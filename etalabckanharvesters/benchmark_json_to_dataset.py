@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the conversion of OpenDataSoft datasets, with and without reuse of the converters built by
+opendatasoftcommon.make_json_to_dataset.
+
+Synthetic datasets are converted the way OpenDataSoft harvesters do it, asking for a converter for each dataset: first
+building a new converter each time (opendatasoftcommon.build_json_to_dataset), then reusing the memoized one.
+"""
+
+
+import argparse
+import logging
+import sys
+import time
+
+from . import opendatasoftcommon
+
+
+app_name = 'benchmark_json_to_dataset'
+conv = opendatasoftcommon.conv
+granularity_translations = {
+    u'Commune': u'commune',
+    u'Région': u'region',
+    }
+license_id_by_license = {
+    u'Licence Ouverte (Etalab)': u'fr-lo',
+    u'Open Database License (ODbL)': u'odc-odbl',
+    }
+log = logging.getLogger(app_name)
+
+
+def convert_datasets(datasets, json_to_dataset_factory):
+    for entry in datasets:
+        dataset = conv.check(json_to_dataset_factory(
+            creators = [
+                u'Benchmark',
+                ],
+            domain = u'benchmark',
+            granularity_translations = granularity_translations,
+            group_title_translations = {
+                u'Transports': u"Territoires et Transports",
+                },
+            license_id_by_license = license_id_by_license,
+            temporals = [
+                u'2014',
+                ],
+            ))(entry, state = conv.default_state)
+        assert dataset is not None
+
+
+def make_dataset(index):
+    return dict(
+        attachments = [
+            dict(
+                id = u'attachment-{}'.format(index),
+                mimetype = u'application/pdf',
+                title = u'Documentation {}'.format(index),
+                url = u'odsfile://benchmark/attachment-{}.pdf'.format(index),
+                ),
+            ],
+        datasetid = u'dataset-{}'.format(index),
+        features = [u'analyze', u'geo'],
+        fields = [],
+        has_records = True,
+        metas = dict(
+            creator = u'Benchmark',
+            domain = u'benchmark',
+            granularity = u'Commune' if index % 2 else u'Région',
+            keyword = [u'Mot clé {}'.format(index % 50), u'Benchmark'],
+            language = u'fr',
+            license = u'Licence Ouverte (Etalab)',
+            modified = u'2014-06-01T12:00:00+00:00',
+            publisher = u'Etalab',
+            temporal = u'2014',
+            theme = u'Transports',
+            title = u'Jeu de données {}'.format(index),
+            visibility = u'domain',
+            ),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--datasets-count', action = 'append', type = int,
+        help = 'number of synthetic datasets to convert (may be repeated, default: 100 & 1000)')
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
+
+    global args
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
+
+    for datasets_count in (args.datasets_count or [100, 1000]):
+        datasets = [
+            make_dataset(index)
+            for index in range(datasets_count)
+            ]
+        for run_name, json_to_dataset_factory in (
+                (u'rebuilt', opendatasoftcommon.build_json_to_dataset),
+                (u'memoized', opendatasoftcommon.make_json_to_dataset),
+                ):
+            start_time = time.time()
+            convert_datasets(datasets, json_to_dataset_factory)
+            duration = time.time() - start_time
+            print u'{} datasets, {} converter: {:.3f} s, {:.0f} datasets/s'.format(datasets_count, run_name,
+                duration, datasets_count / duration)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
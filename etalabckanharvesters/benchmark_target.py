@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the update of a target CKAN by helpers.Harvester, using an in-process fake CKAN.
+
+For each catalog size, a synthetic catalog is harvested twice into a new fake CKAN: a first run creating every package,
+then a run where nothing changed. The throughput of each run is reported.
+
+Unless --target-max-write-rate is given, the rate limiter of writes is disabled (ie its max rate is too high to be
+reached), so that the write path is measured rather than its pacing.
+"""
+
+
+import argparse
+import logging
+import sys
+import time
+
+from . import fakeckan, helpers
+
+
+app_name = 'benchmark_target'
+log = logging.getLogger(app_name)
+unlimited_rate = 1e9  # Max rate of writes disabling the rate limiter
+
+
+def harvest(site_url, packages_count, organizations_count, args):
+    harvester = helpers.Harvester(
+        supplier_abbreviation = u'bch',
+        supplier_title = u'Benchmark',
+        target_headers = {
+            'Authorization': 'fake-api-key',
+            'User-Agent': 'Etalab-CKAN-Harvesters-Benchmark/0.1',
+            },
+        target_site_url = site_url,
+        **helpers.target_options(args))
+    harvester.retrieve_target()
+
+    groups = [
+        harvester.upsert_group(dict(
+            title = group_title,
+            ))
+        for group_title in helpers.groups_title
+        ]
+    organizations = [
+        harvester.upsert_organization(dict(
+            title = u'Organisation {}'.format(index),
+            ))
+        for index in range(organizations_count)
+        ]
+    for index in range(packages_count):
+        harvester.add_package(
+            dict(
+                license_id = u'fr-lo',
+                notes = u'Description du jeu de données {}'.format(index),
+                resources = [
+                    dict(
+                        format = u'CSV',
+                        name = u'Données {}'.format(index),
+                        url = u'http://example.com/datasets/{}/data.csv'.format(index),
+                        ),
+                    ],
+                tags = [
+                    dict(
+                        name = u'mot-cle-{}'.format(index % 50),
+                        ),
+                    ],
+                # Every 10 packages, a title is duplicated, to exercise the naming of packages.
+                title = u'Jeu de données {}'.format(index - index % 10 if index % 10 == 9 else index),
+                ),
+            organizations[index % organizations_count],
+            u'dataset-{}'.format(index),
+            u'http://example.com/datasets/{}'.format(index),
+            groups = [groups[index % len(groups)]],
+            related = [
+                dict(
+                    title = u'Visualisation {}'.format(index),
+                    type = u'visualization',
+                    url = u'http://example.com/visualizations/{}'.format(index),
+                    ),
+                ] if index % 5 == 0 else None,
+            )
+    harvester.update_target()
+    return harvester
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-e', '--error-ratio', default = 0, help = 'ratio of requests failing in fake CKAN',
+        type = float)
+    parser.add_argument('-l', '--latency', default = 0, help = 'latency (in seconds) of every request to fake CKAN',
+        type = float)
+    parser.add_argument('-n', '--packages-count', action = 'append', type = int,
+        help = 'number of packages of a synthetic catalog (may be repeated, default: 1000, 10000 & 100000)')
+    parser.add_argument('-o', '--organizations-count', default = 10, help = 'number of organizations of catalogs',
+        type = int)
+    helpers.add_target_arguments(parser)
+    parser.set_defaults(target_max_write_rate = unlimited_rate)
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
+
+    global args
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
+
+    print u'Write rate limiter: {}, max latency {} s; {} threads'.format(
+        u'disabled' if args.target_max_write_rate >= unlimited_rate
+            else u'max {} requests/s'.format(args.target_max_write_rate),
+        args.target_max_latency, args.thread_count)
+    for packages_count in (args.packages_count or [1000, 10000, 100000]):
+        fake_ckan = fakeckan.FakeCkan(error_ratio = args.error_ratio, latency = args.latency, seed = packages_count)
+        server, site_url = fakeckan.serve(fake_ckan)
+        try:
+            for run_name in (u'initial', u'unchanged'):
+                requests_count = sum(fake_ckan.requests_count_by_action.itervalues())
+                start_time = time.time()
+                harvester = harvest(site_url, packages_count, args.organizations_count, args)
+                duration = time.time() - start_time
+                requests_count = sum(fake_ckan.requests_count_by_action.itervalues()) - requests_count
+                print u'{} packages, {} run: {:.1f} s, {:.1f} packages/s, {} requests ({:.1f} requests/s), ' \
+                    u'final write rate: {}'.format(packages_count, run_name, duration, packages_count / duration,
+                    requests_count, requests_count / duration,
+                    u'unlimited' if harvester.target_client.rate_limiter.rate >= unlimited_rate
+                        else u'{:.1f} requests/s'.format(harvester.target_client.rate_limiter.rate))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
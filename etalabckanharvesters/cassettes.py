@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Record & replay of the HTTP responses of source sites, to rerun a harvest without network
+
+In record mode, every response received through urllib2 (except from excluded hosts, like target CKAN) is stored in a
+cassette directory, as a gzipped JSON file (URL, status, headers & body) named by the hash of the request. In replay
+mode, the responses are served from the cassette and a request missing from the cassette fails, without accessing the
+network.
+"""
+
+
+import base64
+import cStringIO
+import gzip
+import hashlib
+import httplib
+import json
+import logging
+import os
+import urllib
+import urllib2
+import urlparse
+
+
+log = logging.getLogger(__name__)
+modes = ('record', 'replay')
+
+
+class CassetteHandler(urllib2.BaseHandler):
+    """urllib2 handler recording responses into a cassette or replaying them from it"""
+    dir_path = None
+    excluded_hosts = None  # Hosts (netloc) whose requests are neither recorded nor replayed
+    handler_order = 400  # Open before HTTPHandler & process responses after httpmetrics.MetricsHandler.
+    mode = None
+
+    def __init__(self, dir_path, mode, excluded_hosts = None):
+        assert mode in modes, mode
+        self.dir_path = dir_path
+        self.excluded_hosts = set(excluded_hosts or [])
+        self.mode = mode
+        if mode == 'record' and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+    def get_file_path(self, request):
+        key = u'\n'.join([
+            request.get_method(),
+            request.get_full_url().decode('utf-8') if isinstance(request.get_full_url(), str)
+                else request.get_full_url(),
+            hashlib.sha1(request.get_data() or '').hexdigest(),
+            ])
+        return os.path.join(self.dir_path, '{}.json.gz'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def http_open(self, request):
+        if self.mode != 'replay' or self.is_excluded(request):
+            return None
+        file_path = self.get_file_path(request)
+        if not os.path.exists(file_path):
+            raise urllib2.URLError(u'Request missing from cassette: {} {}'.format(request.get_method(),
+                request.get_full_url()))
+        with gzip.open(file_path, 'rb') as cassette_file:
+            record = json.load(cassette_file)
+        headers = httplib.HTTPMessage(cStringIO.StringIO(record['headers'].encode('latin-1')))
+        response = urllib.addinfourl(cStringIO.StringIO(base64.b64decode(record['body'])), headers,
+            record['url'].encode('utf-8'), record['code'])
+        response.msg = record['msg']
+        return response
+
+    def http_response(self, request, response):
+        if self.mode != 'record' or self.is_excluded(request):
+            return response
+        body = response.read()
+        url = response.geturl()
+        record = dict(
+            body = base64.b64encode(body),
+            code = response.code,
+            headers = ''.join(response.info().headers).decode('latin-1'),
+            method = request.get_method(),
+            msg = response.msg,
+            url = url.decode('utf-8') if isinstance(url, str) else url,
+            )
+        file_path = self.get_file_path(request)
+        temporary_file_path = file_path + '.tmp'
+        with gzip.open(temporary_file_path, 'wb') as cassette_file:
+            json.dump(record, cassette_file, sort_keys = True)
+        os.rename(temporary_file_path, file_path)
+        # The body has been consumed: return a new response reading it again.
+        recorded_response = urllib.addinfourl(cStringIO.StringIO(body), response.info(), url, response.code)
+        recorded_response.msg = response.msg
+        return recorded_response
+
+    def is_excluded(self, request):
+        return urlparse.urlsplit(request.get_full_url()).netloc in self.excluded_hosts
+
+    https_open = http_open
+    https_response = http_response
@@ -0,0 +1,302 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Client for the action API of CKAN"""
+
+
+import cStringIO
+import errno
+import httplib
+import itertools
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+from . import httpclients
+
+
+deletion_actions_suffix = ('_delete', '_purge')
+log = logging.getLogger(__name__)
+retried_http_codes = set([429, 500, 502, 503, 504])
+unprocessed_http_codes = set([429, 503])  # Codes of the errors sent by CKAN (or its proxy) before processing a request
+write_actions_suffix = ('_create', '_delete', '_patch', '_purge', '_update')
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of sending a request to CKAN once the deadline of the run is over"""
+
+
+class AdaptiveRateLimiter(object):
+    """Limiter of the rate of requests sent to a server, adapting it to the server load (AIMD)
+
+    Requests are first sent at max_rate. The rate is decreased multiplicatively when a request fails or is slower than
+    max_latency, and then increased additively (up to max_rate again) while requests succeed quickly. A limiter is
+    shared by all the threads sending requests to the same server.
+    """
+    decrease_factor = 0.5
+    decrease_interval = 1.0  # Min delay (in seconds) between two decreases, to react only once to a burst of failures
+    increase_step = 1.0  # Increase of rate (in requests per second) after one second of successful requests
+    last_decrease_time = 0.0
+    lock = None
+    max_latency = 2.0  # Latency (in seconds) above which the server is considered overloaded
+    max_rate = 50.0  # Max number of requests per second
+    min_rate = 0.2
+    next_time = 0.0  # Time before which the next request must not be sent
+    rate = None  # Current number of requests per second (max_rate, until the server gets overloaded)
+
+    def __init__(self, max_latency = None, max_rate = None, min_rate = None, rate = None):
+        if max_latency is not None:
+            self.max_latency = max_latency
+        if max_rate is not None:
+            self.max_rate = max_rate
+        if min_rate is not None:
+            self.min_rate = min_rate
+        assert 0 < self.min_rate <= self.max_rate
+        self.rate = min(max(self.min_rate, rate), self.max_rate) if rate is not None else self.max_rate
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a new request can be sent."""
+        with self.lock:
+            now = time.time()
+            send_time = max(now, self.next_time)
+            self.next_time = send_time + 1.0 / self.rate
+        if send_time > now:
+            time.sleep(send_time - now)
+
+    def record(self, latency, failed = False):
+        """Adapt rate to the latency & the success of a request."""
+        with self.lock:
+            if failed or latency > self.max_latency:
+                now = time.time()
+                if now - self.last_decrease_time >= self.decrease_interval:
+                    self.last_decrease_time = now
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    log.info(u'Server is overloaded, decreasing rate to {:.2f} requests per second'.format(self.rate))
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+
+
+class CkanActionClient(object):
+    """Client calling CKAN actions (action name + parameters -> result)
+
+    Every request has a timeout and is retried, with an exponential backoff, when CKAN answers with a server error or
+    when the connection fails. A *_create action is retried only when CKAN can't have processed it. When its outcome
+    is unknown (timeout, server error, etc), the object is read back from CKAN before creating it again. Likewise, a
+    *_delete action retried after such a failure succeeds when the object is not found anymore. No request is
+    sent once the deadline of the run is over. Write actions are throttled by a rate limiter, adapting their rate to
+    the load of CKAN. A client can be shared between threads.
+    """
+    backoff_delay = 1.0  # Delay (in seconds) before the first retry. It is doubled at each new retry.
+    backoff_max_delay = 60.0
+    deadline = None  # Time (as given by time.time()) after which no request is sent anymore
+    headers = None
+    http_client = None
+    max_attempts = 5  # Number of times a request is sent before giving up
+    rate_limiter = None  # Limiter of the rate of write actions
+    site_url = None
+    timeout = 60.0  # Timeout (in seconds) of each request
+
+    def __init__(self, site_url, headers = None, deadline = None, http_client = None, max_attempts = None,
+            rate_limiter = None, timeout = None):
+        self.site_url = site_url
+        self.headers = headers or {}
+        if deadline is not None:
+            self.deadline = deadline
+        self.http_client = http_client if http_client is not None else httpclients.PooledHttpClient()
+        if max_attempts is not None:
+            assert max_attempts >= 1
+            self.max_attempts = max_attempts
+        self.rate_limiter = rate_limiter if rate_limiter is not None else AdaptiveRateLimiter()
+        if timeout is not None:
+            self.timeout = timeout
+
+    def backoff(self, attempt, url, failure):
+        """Wait before the next attempt of a failed request."""
+        delay = min(self.backoff_max_delay, self.backoff_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        if self.deadline is not None and time.time() + delay >= self.deadline:
+            raise DeadlineExceeded(u'Deadline exceeded while retrying {}'.format(url))
+        log.warning(u'Request to {} failed ({}), retrying in {:.1f} seconds'.format(url, failure, delay))
+        time.sleep(delay)
+
+    def call(self, action, params = None, data = None):
+        """Call a CKAN action and return its result.
+
+        params are sent in the query of the URL. data, when not None, is sent as JSON in the body of a POST request.
+
+        A CKAN error is raised as an urllib2.HTTPError, logged unless it is a 404 (not found) error.
+        """
+        if action.endswith(deletion_actions_suffix):
+            return self.call_deletion(action, params = params, data = data)
+        if not action.endswith('_create'):
+            return self.send_action(action, params = params, data = data)
+        kind = action[:-len('_create')]
+        key = 'dataset_id' if kind == 'related' else 'name'
+        for attempt in itertools.count(1):
+            try:
+                return self.send_action(action, params = params, data = data, unprocessed_retries_only = True)
+            except (httplib.HTTPException, socket.error, urllib2.URLError) as error:
+                # Errors proving that the request has not been processed have already been retried by urlopen.
+                if not is_outcome_unknown(error) or attempt >= self.max_attempts or data is None \
+                        or data.get(key) is None:
+                    raise
+                failure = unicode(error) or error.__class__.__name__
+            # The object may have been created by the failed request.
+            self.backoff(attempt, urlparse.urljoin(self.site_url, 'api/3/action/{}'.format(action)), failure)
+            created = self.retrieve_created(kind, data)
+            if created is not None:
+                log.info(u'Action {} succeeded despite failure ({}): {}'.format(action, failure, data[key]))
+                return created
+
+    def call_deletion(self, action, params = None, data = None):
+        """Call a *_delete or *_purge action. When it is retried after a failure whose outcome is unknown, a 404 (not
+        found) error means that the object has been deleted by the failed request: None is then returned.
+        """
+        failure = None
+        for attempt in itertools.count(1):
+            try:
+                return self.send_action(action, params = params, data = data, unprocessed_retries_only = True)
+            except (httplib.HTTPException, socket.error, urllib2.URLError) as error:
+                if attempt > 1 and isinstance(error, urllib2.HTTPError) and error.code == 404:
+                    log.info(u'Action {} succeeded despite failure ({}): {}'.format(action, failure,
+                        data if data is not None else params))
+                    return None
+                # Errors proving that the request has not been processed have already been retried by urlopen.
+                if not is_outcome_unknown(error) or attempt >= self.max_attempts:
+                    raise
+                failure = unicode(error) or error.__class__.__name__
+            self.backoff(attempt, urlparse.urljoin(self.site_url, 'api/3/action/{}'.format(action)), failure)
+
+    def retrieve_created(self, kind, data):
+        """Retrieve from CKAN the object (package, group, etc) of the given kind that data describes, or None."""
+        try:
+            if kind == 'related':
+                for related_link in self.send_action('related_list', params = dict(id = data['dataset_id'])) or []:
+                    if all(related_link.get(key) == data.get(key) for key in ('title', 'type', 'url')):
+                        return related_link
+                return None
+            created = self.send_action('{}_show'.format(kind), params = dict(id = data['name']))
+        except urllib2.HTTPError as error:
+            if error.code == 404:
+                return None
+            raise
+        return created if created.get('state', 'active') == 'active' else None
+
+    def send_action(self, action, params = None, data = None, unprocessed_retries_only = False):
+        url = urlparse.urljoin(self.site_url, 'api/3/action/{}'.format(action))
+        if params:
+            url = u'{}?{}'.format(url, urllib.urlencode(sorted(
+                (key, value.encode('utf-8') if isinstance(value, unicode) else value)
+                for key, value in params.iteritems()
+                )))
+        request = urllib2.Request(url, headers = self.headers)
+        try:
+            response = self.urlopen(request, urllib.quote(json.dumps(data)) if data is not None else None,
+                rate_limited = action.endswith(write_actions_suffix),
+                unprocessed_retries_only = unprocessed_retries_only)
+        except urllib2.HTTPError as error:
+            response_text = error.read()
+            if error.code != 404:
+                log.error(u'An exception occured while calling action {}: {}'.format(action,
+                    data if data is not None else params))
+                try:
+                    response_dict = json.loads(response_text)
+                except ValueError:
+                    log.error(response_text)
+                else:
+                    for key, value in response_dict.iteritems():
+                        log.debug('{} = {}'.format(key, value))
+            # Response has been read: Raise a new error whose body can be read again.
+            raise urllib2.HTTPError(error.filename, error.code, error.msg, error.hdrs,
+                cStringIO.StringIO(response_text))
+        response_text = response.read()
+        try:
+            response_dict = json.loads(response_text)
+        except ValueError:
+            log.error(u'An exception occured while reading result of action {}: {}'.format(action,
+                data if data is not None else params))
+            log.error(response_text)
+            raise
+        assert response_dict['success'] is True, response_dict
+        return response_dict['result']
+
+    def urlopen(self, request, data = None, rate_limited = False, unprocessed_retries_only = False):
+        """Open an URL like urllib2.urlopen, but with a timeout, retries and a deadline.
+
+        When rate_limited is true, the request is throttled by the rate limiter (and its latency adapts the rate).
+        When unprocessed_retries_only is true, the request is retried only after a failure proving that it has not been
+        processed (connection refused, etc), because sending it twice is not safe.
+        """
+        for attempt in itertools.count(1):
+            timeout = self.timeout
+            if self.deadline is not None:
+                remaining_time = self.deadline - time.time()
+                if remaining_time <= 0:
+                    raise DeadlineExceeded(u'Deadline exceeded before requesting {}'.format(request.get_full_url()))
+                timeout = min(timeout, remaining_time) if timeout is not None else remaining_time
+            if rate_limited:
+                self.rate_limiter.acquire()
+            start_time = time.time()
+            try:
+                response = self.http_client.urlopen(request, data, timeout = timeout)
+            except urllib2.HTTPError as error:
+                if rate_limited:
+                    self.rate_limiter.record(time.time() - start_time, failed = error.code in retried_http_codes)
+                if error.code not in (unprocessed_http_codes if unprocessed_retries_only else retried_http_codes) \
+                        or attempt >= self.max_attempts:
+                    raise
+                failure = u'HTTP error {}'.format(error.code)
+            except (httplib.HTTPException, socket.error, urllib2.URLError) as error:
+                if rate_limited:
+                    self.rate_limiter.record(time.time() - start_time, failed = True)
+                if attempt >= self.max_attempts or unprocessed_retries_only and not is_connection_refused(error):
+                    raise
+                failure = unicode(error) or error.__class__.__name__
+            else:
+                if rate_limited:
+                    self.rate_limiter.record(time.time() - start_time)
+                return response
+            self.backoff(attempt, request.get_full_url(), failure)
+
+
+def is_connection_refused(error):
+    """Return whether a connection error means that the request has not been sent at all."""
+    if isinstance(error, urllib2.URLError) and isinstance(error.reason, socket.error):
+        error = error.reason
+    return isinstance(error, socket.error) and error.errno == errno.ECONNREFUSED
+
+
+def is_outcome_unknown(error):
+    """Return whether a request may have been processed by CKAN despite the error raised while sending it."""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in retried_http_codes and error.code not in unprocessed_http_codes
+    return not is_connection_refused(error)
@@ -43,6 +43,8 @@ import urlparse
 from biryani1 import baseconv, custom_conv, datetimeconv
 from lxml import etree
 
+from .. import httpmetrics
+
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
 args = None
@@ -65,11 +67,14 @@ def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('download_dir', help = 'directory where to store downloaded HTML pages')
     parser.add_argument('-c', '--thread-count', default = 1, help = 'max number of threads', type = int)
+    parser.add_argument('--metrics-dir',
+        help = 'directory where a report of HTTP requests is written (as JSON & as Prometheus textfile)')
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
+    httpmetrics.install_opener(u'download-data-angers-fr', metrics_dir = args.metrics_dir)
 
     if not os.path.exists(args.download_dir):
         os.makedirs(args.download_dir)
@@ -70,6 +70,7 @@ def main():
     parser.add_argument('config', help = 'path of configuration file')
     parser.add_argument('-d', '--dry-run', action = 'store_true',
         help = "simulate harvesting, don't update CKAN repository")
+    helpers.add_target_arguments(parser)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
@@ -111,7 +112,7 @@ def main():
             'User-Agent': conf['user_agent'],
             },
         target_site_url = conf['ckan.site_url'],
-        )
+        **helpers.target_options(args))
     source_headers = {
         'User-Agent': conf['user_agent'],
         }
@@ -120,61 +121,68 @@ def main():
     if not args.dry_run:
         harvester.retrieve_target()
 
-    # Retrieve list of packages in source.
-    datasets = opendatasoftcommon.retrieve_datasets(source_headers, source_site_url)
+    opendatasoftcommon.open_markdown_cache(args.state_dir)
+    datasets_index = opendatasoftcommon.DatasetsIndex(args.state_dir, source_site_url)
+    json_to_dataset = datasets_index.wrap_json_to_dataset(
+        opendatasoftcommon.make_json_to_dataset(
+            creators = [
+#                u'SNCF Transilien',
+                ],
+            domain = u'datacorsica',
+            granularity_translations = granularity_translations,
+            group_title_translations = {
+                u'Administration': u"Société",
+                u'Agriculture': u"Agriculture et Alimentation",
+                u'Budget \u2013 Finances': u'Économie et Emploi',
+                u'Culture \u2013 Patrimoine': u"Culture",
+                u'Développement Durable': u"Logement, Développement durable et Énergie",
+                u'Economie et Entreprise': u"Économie et Emploi",
+                u'Education \u2013 Formation': u"Éducation et Recherche",
+                u'Emploi': u"Économie et Emploi",
+                u'Energie': u"Logement, Développement durable et Énergie",
+                u'Environnement': u"Logement, Développement durable et Énergie",
+                u'Social': u"Santé et Social",
+                u'TIC': u"Éducation et Recherche",
+                u'Tourisme': u"Société",
+                u'Transport': u"Territoires et Transports",
+                u'Urbanisme': u"Territoires et Transports",
+                },
+            license_id_by_license = license_id_by_license,
+            temporals = [
+                ],
+            ),
+        )
 
+    # Retrieve packages of source page by page, converting each page while the next ones are being retrieved.
     all_tags_name = set()
-    for entry in datasets:
-        dataset = conv.check(
-            opendatasoftcommon.make_json_to_dataset(
-                creators = [
-#                    u'SNCF Transilien',
-                    ],
-                domain = u'datacorsica',
-                granularity_translations = granularity_translations,
-                group_title_translations = {
-                    u'Administration': u"Société",
-                    u'Agriculture': u"Agriculture et Alimentation",
-                    u'Budget \u2013 Finances': u'Économie et Emploi',
-                    u'Culture \u2013 Patrimoine': u"Culture",
-                    u'Développement Durable': u"Logement, Développement durable et Énergie",
-                    u'Economie et Entreprise': u"Économie et Emploi",
-                    u'Education \u2013 Formation': u"Éducation et Recherche",
-                    u'Emploi': u"Économie et Emploi",
-                    u'Energie': u"Logement, Développement durable et Énergie",
-                    u'Environnement': u"Logement, Développement durable et Énergie",
-                    u'Social': u"Santé et Social",
-                    u'TIC': u"Éducation et Recherche",
-                    u'Tourisme': u"Société",
-                    u'Transport': u"Territoires et Transports",
-                    u'Urbanisme': u"Territoires et Transports",
-                    },
+    for datasets in opendatasoftcommon.iter_datasets_pages(source_headers, source_site_url):
+        opendatasoftcommon.prepare_datasets_conversion(datasets, datasets_index)
+        for entry in datasets:
+            dataset = conv.check(json_to_dataset)(entry, state = conv.default_state)
+            if dataset is None:
+                continue
+            metas = dataset['metas']
+
+            tags_name = metas[u'keyword']
+            all_tags_name.update(tags_name or [])
+
+            opendatasoftcommon.add_dataset(
+                dataset = dataset,
+                dry_run = args.dry_run,
+                harvester = harvester,
                 license_id_by_license = license_id_by_license,
-                temporals = [
-                    ],
-                ),
-            )(entry, state = conv.default_state)
-        if dataset is None:
-            continue
-        metas = dataset['metas']
-
-        tags_name = metas[u'keyword']
-        all_tags_name.update(tags_name or [])
-
-        opendatasoftcommon.add_dataset(
-            dataset = dataset,
-            dry_run = args.dry_run,
-            harvester = harvester,
-            license_id_by_license = license_id_by_license,
-            granularity_translations = granularity_translations,
-            publishers_to_ignore = set([
-#                u"OpenStreetMap",
-                ]),
-            source_site_url = source_site_url,
-            territorial_collectivity = True,
-            territorial_coverage = u'RegionOfFrance/94/CORSE',
-            territory_by_tag_name = territory_by_tag_name,
-            )
+                granularity_translations = granularity_translations,
+                publishers_to_ignore = set([
+#                    u"OpenStreetMap",
+                    ]),
+                source_site_url = source_site_url,
+                territorial_collectivity = True,
+                territorial_coverage = u'RegionOfFrance/94/CORSE',
+                territory_by_tag_name = territory_by_tag_name,
+                )
+
+    datasets_index.save()
+    opendatasoftcommon.close_markdown_cache()
 
     if not args.dry_run:
         harvester.update_target()
@@ -210,6 +210,7 @@ def main():
     parser.add_argument('config', help = 'path of configuration file')
     parser.add_argument('-d', '--dry-run', action = 'store_true',
         help = "simulate harvesting, don't update CKAN repository")
+    helpers.add_target_arguments(parser)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
@@ -251,7 +252,7 @@ def main():
             'User-Agent': conf['user_agent'],
             },
         target_site_url = conf['ckan.site_url'],
-        )
+        **helpers.target_options(args))
     source_headers = {
         'User-Agent': conf['user_agent'],
         }
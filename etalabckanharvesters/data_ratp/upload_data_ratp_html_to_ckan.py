@@ -62,6 +62,7 @@ def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('config', help = 'path of configuration file')
     parser.add_argument('download_dir', help = 'directory where are stored downloaded HTML pages')
+    helpers.add_target_arguments(parser)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
@@ -103,7 +104,7 @@ def main():
             'User-Agent': conf['user_agent'],
             },
         target_site_url = conf['ckan.site_url'],
-        )
+        **helpers.target_options(args))
 
     # Retrieve paths of HTML pages to convert.
     data_dir = os.path.join(args.download_dir, 'data')
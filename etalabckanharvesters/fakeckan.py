@@ -0,0 +1,459 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""In-process fake CKAN, to benchmark the update of a target without touching a real CKAN
+
+The WSGI application implements, in memory, the subset of CKAN API used by helpers.Harvester: package_*, group_*,
+organization_* & related_* actions, and the storage API used by ckantoolbox.filestores.upload_file. A latency can be
+added to every request and a ratio of action requests can fail with a "503 Service Unavailable" error (the storage API
+never fails, because filestores.upload_file doesn't retry).
+"""
+
+
+import cgi
+import datetime
+import hashlib
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from wsgiref import simple_server
+
+
+filter_query_clause_re = re.compile(ur'\+?(\w+):(\[[^\]]*\]|\([^)]*\)|"[^"]*"|\S+)')
+
+
+class FakeCkan(object):
+    """WSGI application simulating a CKAN site. It can be called simultaneously from several threads."""
+    error_ratio = 0.0  # Ratio of action requests failing with a 503 error
+    file_by_label = None
+    group_by_name = None
+    latency = 0.0  # Delay (in seconds) added to every request
+    lock = None
+    organization_by_name = None
+    package_by_id = None
+    package_by_name = None
+    random = None
+    related_by_id = None
+    related_ids_by_package_id = None
+    requests_count_by_action = None
+
+    def __init__(self, error_ratio = None, latency = None, seed = None):
+        if error_ratio is not None:
+            assert 0 <= error_ratio < 1
+            self.error_ratio = error_ratio
+        if latency is not None:
+            assert latency >= 0
+            self.latency = latency
+        self.file_by_label = {}
+        self.group_by_name = {}
+        self.lock = threading.Lock()
+        self.organization_by_name = {}
+        self.package_by_id = {}
+        self.package_by_name = {}
+        self.random = random.Random(seed)
+        self.related_by_id = {}
+        self.related_ids_by_package_id = {}
+        self.requests_count_by_action = {}
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO') or '/'
+        if path.startswith('/api/3/action/'):
+            action = path[len('/api/3/action/'):]
+        elif path.startswith('/api/storage/'):
+            action = 'storage_' + path[len('/api/storage/'):].split('/', 1)[0]
+        elif path.startswith('/storage/'):
+            action = 'storage_file' if path.startswith('/storage/f/') else 'storage_upload'
+        else:
+            action = None
+        with self.lock:
+            self.requests_count_by_action[action] = self.requests_count_by_action.get(action, 0) + 1
+            failed = action is not None and not action.startswith('storage_') \
+                and self.random.random() < self.error_ratio
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return respond_error(start_response, '503 Service Unavailable', u'Injected error')
+        if action is None:
+            return respond_error(start_response, '404 Not Found', u'Not found')
+        if action.startswith('storage_'):
+            return self.handle_storage(environ, start_response, action, path)
+
+        params = dict(
+            (key, value.decode('utf-8'))
+            for key, value in urlparse.parse_qsl(environ.get('QUERY_STRING') or '')
+            )
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        if body:
+            try:
+                params.update(json.loads(urllib.unquote(body)))
+            except ValueError:
+                return respond_error(start_response, '400 Bad Request', u'Invalid JSON body')
+        handler = getattr(self, 'action_' + action, None)
+        if handler is None:
+            return respond_error(start_response, '400 Bad Request', u'Unknown action: {}'.format(action))
+        try:
+            with self.lock:
+                result = handler(params)
+        except KeyError as error:
+            return respond_error(start_response, '404 Not Found', u'Not found: {}'.format(error))
+        except ValueError as error:
+            return respond_error(start_response, '409 Conflict', unicode(error))
+        return respond(start_response, '200 OK', dict(help = u'', result = result, success = True))
+
+    def action_group_create(self, params):
+        return self.create_group(self.group_by_name, params, False)
+
+    def action_group_list(self, params):
+        return list_groups(self.group_by_name, params)
+
+    def action_group_show(self, params):
+        return find_by_id_or_name(self.group_by_name, params['id'])
+
+    def action_group_update(self, params):
+        return self.update_group(self.group_by_name, params, False)
+
+    def action_organization_create(self, params):
+        return self.create_group(self.organization_by_name, params, True)
+
+    def action_organization_list(self, params):
+        return list_groups(self.organization_by_name, params)
+
+    def action_organization_show(self, params):
+        return find_by_id_or_name(self.organization_by_name, params['id'])
+
+    def action_organization_update(self, params):
+        return self.update_group(self.organization_by_name, params, True)
+
+    def action_package_create(self, params):
+        name = params.get('name')
+        if not name:
+            raise ValueError(u'Missing name')
+        existing_package = self.package_by_name.get(name)
+        if existing_package is not None and existing_package['state'] != 'deleted':
+            raise ValueError(u'That URL is already in use: {}'.format(name))
+        package = self.make_package(params, existing_package)
+        self.package_by_id[package['id']] = self.package_by_name[name] = package
+        return package
+
+    def action_package_delete(self, params):
+        package = self.find_package(params['id'])
+        package['metadata_modified'] = now_str()
+        package['state'] = 'deleted'
+        return None
+
+    def action_package_search(self, params):
+        # Filter query: "owner_org:<id>", "metadata_modified:[<date> TO *]" & "state:(<state> OR ...)" clauses.
+        clauses = dict(
+            (field, value)
+            for field, value in filter_query_clause_re.findall(params.get('fq') or u'')
+            )
+        owner_org = clauses.get('owner_org', u'').strip(u'"') or None
+        modified_since = clauses.get('metadata_modified', u'[* TO *]')[1:-1].split(u' TO ')[0].rstrip(u'Z')
+        states = clauses.get('state', u'active').strip(u'()').split(u' OR ')
+        packages = sorted(
+            (
+                package
+                for package in self.package_by_name.itervalues()
+                if package['state'] in states and (owner_org is None or package['owner_org'] == owner_org)
+                    and (modified_since == u'*' or package['metadata_modified'] >= modified_since)
+                ),
+            key = lambda package: package['name'],
+            )
+        start = int(params.get('start') or 0)
+        rows = int(params.get('rows') or 10)
+        return dict(
+            count = len(packages),
+            results = packages[start:start + rows],
+            )
+
+    def action_package_show(self, params):
+        package = self.find_package(params['id'])
+        if package['state'] == 'deleted':
+            raise KeyError(params['id'])
+        return package
+
+    def action_package_update(self, params):
+        existing_package = self.find_package(params.get('id') or params['name'])
+        package = self.make_package(params, existing_package)
+        if package['name'] != existing_package['name']:
+            del self.package_by_name[existing_package['name']]
+        self.package_by_id[package['id']] = self.package_by_name[package['name']] = package
+        return package
+
+    def action_related_create(self, params):
+        package = self.find_package(params['dataset_id'])
+        related = dict(
+            (key, value)
+            for key, value in params.iteritems()
+            if key in ('description', 'image_url', 'title', 'type', 'url')
+            )
+        related.update(
+            created = now_str(),
+            dataset_id = package['id'],
+            id = unicode(uuid.uuid4()),
+            view_count = 0,
+            )
+        self.related_by_id[related['id']] = related
+        self.related_ids_by_package_id.setdefault(package['id'], set()).add(related['id'])
+        return related
+
+    def action_related_delete(self, params):
+        related = self.related_by_id.pop(params['id'])
+        self.related_ids_by_package_id[related['dataset_id']].discard(related['id'])
+        return None
+
+    def action_related_list(self, params):
+        package = self.find_package(params['id'])
+        return [
+            self.related_by_id[related_id]
+            for related_id in sorted(self.related_ids_by_package_id.get(package['id']) or [])
+            ]
+
+    def create_group(self, group_by_name, params, is_organization):
+        name = params.get('name')
+        if not name:
+            raise ValueError(u'Missing name')
+        if name in group_by_name:
+            raise ValueError(u'Group name already exists in database')
+        group = group_by_name[name] = make_group(params, None, is_organization)
+        return group
+
+    def find_package(self, id_or_name):
+        package = self.package_by_name.get(id_or_name) or self.package_by_id.get(id_or_name)
+        if package is None:
+            raise KeyError(id_or_name)
+        return package
+
+    def handle_storage(self, environ, start_response, action, path):
+        if action == 'storage_auth':
+            # /api/storage/auth/form/<label>
+            label = path.split('/form/', 1)[1]
+            return respond(start_response, '200 OK', dict(
+                action = '/storage/upload_handle',
+                fields = [
+                    dict(
+                        name = 'key',
+                        value = label,
+                        ),
+                    ],
+                ))
+        if action == 'storage_metadata':
+            # /api/storage/metadata/<label>
+            label = path.split('/metadata/', 1)[1]
+            with self.lock:
+                metadata = (self.file_by_label.get(label) or {}).get('metadata')
+            if metadata is None:
+                return respond_error(start_response, '404 Not Found', u'Not found: {}'.format(label))
+            return respond(start_response, '200 OK', metadata)
+        if action == 'storage_upload':
+            form = cgi.FieldStorage(fp = environ['wsgi.input'], environ = environ, keep_blank_values = True)
+            label = form.getfirst('key')
+            content = form['file'].value if 'file' in form else ''
+            host_url = u'{}://{}'.format(environ['wsgi.url_scheme'], environ.get('HTTP_HOST') or environ['SERVER_NAME'])
+            now = now_str()
+            with self.lock:
+                existing_file = self.file_by_label.get(label)
+                self.file_by_label[label] = dict(
+                    content = content,
+                    metadata = {
+                        '_checksum': u'md5:{}'.format(hashlib.md5(content).hexdigest()),
+                        '_content_length': len(content),
+                        '_creation_date': existing_file['metadata']['_creation_date'] if existing_file else now,
+                        '_label': label,
+                        '_last_modified': now,
+                        '_location': u'{}/storage/f/{}'.format(host_url, label),
+                        },
+                    )
+            start_response('303 See Other', [('Location', '/storage/f/{}'.format(label)), ('Content-Length', '0')])
+            return ['']
+        # storage_file: /storage/f/<label>
+        label = path[len('/storage/f/'):]
+        with self.lock:
+            content = (self.file_by_label.get(label) or {}).get('content')
+        if content is None:
+            return respond_error(start_response, '404 Not Found', u'Not found: {}'.format(label))
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(content)))])
+        return [content]
+
+    def make_package(self, params, existing_package):
+        now = now_str()
+        package_id = existing_package['id'] if existing_package is not None else unicode(uuid.uuid4())
+        owner_org = params.get('owner_org')
+        organization = find_by_id_or_name(self.organization_by_name, owner_org) if owner_org else None
+        package = dict(
+            (key, value)
+            for key, value in params.iteritems()
+            if key not in ('groups', 'id', 'resources', 'tags')
+            )
+        package.update(
+            groups = [
+                summarize_group(find_by_id_or_name(self.group_by_name, group.get('id') or group['name']))
+                for group in (params.get('groups') or [])
+                ],
+            id = package_id,
+            metadata_created = existing_package['metadata_created'] if existing_package is not None else now,
+            metadata_modified = now,
+            organization = summarize_group(organization) if organization is not None else None,
+            owner_org = organization['id'] if organization is not None else None,
+            private = False,
+            resources = [
+                dict(
+                    resource,
+                    id = resource.get('id') or unicode(uuid.uuid4()),
+                    package_id = package_id,
+                    position = position,
+                    )
+                for position, resource in enumerate(params.get('resources') or [])
+                ],
+            revision_id = unicode(uuid.uuid4()),
+            state = 'active',
+            tags = [
+                dict(
+                    display_name = tag['name'],
+                    id = unicode(uuid.uuid5(uuid.NAMESPACE_URL, tag['name'].encode('utf-8'))),
+                    name = tag['name'],
+                    state = 'active',
+                    vocabulary_id = None,
+                    )
+                for tag in (params.get('tags') or [])
+                ],
+            type = u'dataset',
+            )
+        package['num_resources'] = len(package['resources'])
+        package['num_tags'] = len(package['tags'])
+        return package
+
+    def update_group(self, group_by_name, params, is_organization):
+        existing_group = find_by_id_or_name(group_by_name, params['id'])
+        group = dict(params, id = existing_group['id'], name = params.get('name') or existing_group['name'])
+        if group['name'] != existing_group['name']:
+            del group_by_name[existing_group['name']]
+        group = group_by_name[group['name']] = make_group(group, existing_group, is_organization)
+        return group
+
+
+class QuietWsgiRequestHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingWsgiServer(SocketServer.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+def find_by_id_or_name(item_by_name, id_or_name):
+    item = item_by_name.get(id_or_name)
+    if item is not None:
+        return item
+    for item in item_by_name.itervalues():
+        if item['id'] == id_or_name:
+            return item
+    raise KeyError(id_or_name)
+
+
+def list_groups(group_by_name, params):
+    groups = sorted(
+        (
+            group
+            for group in group_by_name.itervalues()
+            if group['state'] == 'active'
+            ),
+        key = lambda group: group['name'],
+        )
+    if params.get('all_fields') in (True, u'True', u'true', u'1'):
+        return [
+            dict(
+                (key, value)
+                for key, value in group.iteritems()
+                if key != 'extras' and (key != 'users' or params.get('include_users') in (True, u'True', u'true', u'1'))
+                )
+            for group in groups
+            ]
+    return [
+        group['name']
+        for group in groups
+        ]
+
+
+def make_group(params, existing_group, is_organization):
+    group = dict(params)
+    group.update(
+        created = existing_group['created'] if existing_group is not None else now_str(),
+        id = existing_group['id'] if existing_group is not None else unicode(uuid.uuid4()),
+        is_organization = is_organization,
+        revision_id = unicode(uuid.uuid4()),
+        state = params.get('state') or 'active',
+        type = u'organization' if is_organization else u'group',
+        )
+    group.setdefault('description', u'')
+    group.setdefault('image_url', u'')
+    group.setdefault('title', group['name'])
+    group['display_name'] = group['title']
+    return group
+
+
+def now_str():
+    return datetime.datetime.utcnow().isoformat().decode('utf-8')
+
+
+def respond(start_response, status, value):
+    body = json.dumps(value)
+    start_response(status, [('Content-Type', 'application/json;charset=utf-8'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def respond_error(start_response, status, message):
+    return respond(start_response, status, dict(
+        error = dict(
+            __type = status.split(' ', 1)[1],
+            message = message,
+            ),
+        help = u'',
+        success = False,
+        ))
+
+
+def serve(application, host = '127.0.0.1', port = 0):
+    """Serve a WSGI application from a background thread and return the server & its URL."""
+    server = simple_server.make_server(host, port, application, server_class = ThreadingWsgiServer,
+        handler_class = QuietWsgiRequestHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, u'http://{}:{}/'.format(*server.server_address)
+
+
+def summarize_group(group):
+    return dict(
+        (key, group.get(key))
+        for key in ('description', 'display_name', 'id', 'image_url', 'is_organization', 'name', 'title', 'type')
+        )
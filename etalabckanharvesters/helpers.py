@@ -27,18 +27,27 @@
 """Helpers for harvesters"""
 
 
+import atexit
+import collections
 import cStringIO
 import csv
+import hashlib
 import itertools
 import json
 import logging
-import urllib
+import os
+import Queue
+import sys
+import threading
+import time
 import urllib2
 import urlparse
 
 from biryani1 import baseconv, custom_conv, states, strings
 from ckantoolbox import ckanconv, filestores
 
+from . import cassettes, ckanclients, httpcaches, httpclients, httpmetrics, journals, packagestores, snapshots
+
 conv = custom_conv(baseconv, ckanconv, states)
 groups_title = [
     u"Agriculture et Alimentation",
@@ -53,32 +62,67 @@ groups_title = [
     u"Territoires et Transports",
     ]
 log = logging.getLogger(__name__)
+ordered_keys = set([
+    'resources',
+    ])
 
 
 class Harvester(object):
     admin_name = None
+    existing_group_by_name = None  # Groups of target (as JSON) retrieved in bulk by retrieve_groups_and_organizations
+    existing_organization_by_name = None  # Organizations of target (as JSON), retrieved with existing groups
+    existing_package_by_name = None  # Packages of target (in a store), retrieved by retrieve_organization_packages
+    existing_package_infos_by_name = None  # ID, title & fingerprint of each package of existing_package_by_name
     existing_packages_name = None
     group_by_name = None
+    http_metrics = None  # Statistics of the HTTP requests sent to source & target sites
+    journal = None  # Optional journal of the operations done in target, to resume an interrupted run
+    journals_dir = None  # When set, directory of the journals, where update_target creates the journal of the run
+    lock = None  # Lock protecting the counters updated by concurrent threads
+    max_deletions_min = 10  # Number of obsolete packages that can always be deleted
+    max_deletions_ratio = 0.5  # Max ratio of existing packages that can be deleted by a harvest
+    metrics_dir = None  # When set, directory where the report of HTTP requests is written at exit
+    next_package_index_by_slug = None  # Cache of name_package: first index of a slug whose name may be free
     old_supplier_name = None
     old_supplier_title = None
     organization_by_name = None
     organization_name_by_package_name = None
-    package_by_name = None
+    package_by_name = None  # Harvested packages, kept in a store (in memory or on disk)
+    package_model = None  # Union of the keys of harvested packages (see canonicalize), to detect the dropped fields
+    package_slug_by_title = None  # Cache of name_package
     package_source_by_name = None
-    packages_by_organization_name = None
+    packages_by_organization_name = None  # Names & titles of the packages upserted in each organization
+    packages_count_by_operation = None  # Number of packages created, deleted, skipped (because unchanged) & updated
+    prefetched_organizations_id = None  # IDs of organizations whose packages are all in existing_package_by_name
     related_by_package_name = None
+    resume = False  # When true, update_target resumes the latest interrupted run (or the run_id one)
+    run_id = None
+    search_rows = 1000  # Number of packages retrieved by each package_search
+    snapshot = None  # Optional local snapshot of target, used to skip the packages unchanged since previous harvest
     supplier_abbreviation = None
     supplier = None
     supplier_name = None
     supplier_title = None
+    target_client = None  # CKAN client shared by every request sent to target
     target_headers = None
     target_site_url = None
+    thread_count = 1  # Maximum number of threads used to upsert packages into target
+    verify_target = False  # When true, read back every upserted package from target
 
-    def __init__(self, admin_name = None, old_supplier_title = None, supplier_abbreviation = None,
-            supplier_title = None, target_headers = None, target_site_url = None):
+    def __init__(self, admin_name = None, cassette_dir = None, cassette_mode = None, max_deletions_ratio = None,
+            metrics_dir = None, old_supplier_title = None, package_store = 'memory', resume = False, run_id = None,
+            source_cache_dir = None, supplier_abbreviation = None, state_dir = None, supplier_title = None,
+            target_deadline = None, target_headers = None, target_max_latency = None, target_max_write_rate = None,
+            target_site_url = None, target_timeout = None, thread_count = None, verify_target = False):
         if admin_name is not None:
             self.admin_name = admin_name
 
+        if max_deletions_ratio is not None:
+            assert 0 <= max_deletions_ratio <= 1
+            self.max_deletions_ratio = max_deletions_ratio
+
+        self.metrics_dir = metrics_dir
+
         if old_supplier_title is not None:
             assert isinstance(old_supplier_title, unicode)
             self.old_supplier_title = old_supplier_title
@@ -107,14 +151,66 @@ class Harvester(object):
         assert isinstance(target_site_url, unicode)
         self.target_site_url = target_site_url
 
+        # Time every request sent to source sites (through urllib2) & to target (through the pooled HTTP client).
+        self.http_metrics = httpmetrics.HttpMetrics()
+        # Report them at exit, whatever the outcome of the run (dry run, failure, interruption...).
+        atexit.register(self.report_http_metrics)
+        source_handlers = [httpmetrics.MetricsHandler(self.http_metrics)]
+        if source_cache_dir is not None:
+            # Revalidate cached responses of source sites instead of downloading them again.
+            source_handlers.append(httpcaches.ConditionalCacheHandler(source_cache_dir,
+                excluded_hosts = [urlparse.urlsplit(target_site_url).netloc]))
+        if cassette_dir is not None:
+            # Record or replay the responses of source sites (but not of target).
+            source_handlers.append(cassettes.CassetteHandler(cassette_dir, cassette_mode or 'replay',
+                excluded_hosts = [urlparse.urlsplit(target_site_url).netloc]))
+        urllib2.install_opener(urllib2.build_opener(*source_handlers))
+        self.target_client = ckanclients.CkanActionClient(target_site_url,
+            deadline = time.time() + target_deadline if target_deadline is not None else None,
+            headers = target_headers,
+            http_client = httpclients.PooledHttpClient(metrics = self.http_metrics),
+            rate_limiter = ckanclients.AdaptiveRateLimiter(
+                max_latency = target_max_latency,
+                max_rate = target_max_write_rate,
+                ),
+            timeout = target_timeout,
+            )
+
+        if thread_count is not None:
+            assert thread_count >= 1
+            self.thread_count = thread_count
+
+        self.verify_target = verify_target
+
+        if state_dir is not None:
+            self.journals_dir = os.path.join(state_dir, 'journals', supplier_abbreviation)
+            self.resume = resume
+            self.run_id = run_id
+            self.snapshot = snapshots.TargetSnapshot(state_dir, target_site_url, supplier_abbreviation)
+        else:
+            assert not resume, u'A run can only be resumed when a state directory is given'
+
+        self.existing_package_by_name = packagestores.new_store(package_store)
+        self.existing_package_infos_by_name = {}
         self.existing_packages_name = set()
         self.group_by_name = {}
+        self.lock = threading.Lock()
+        self.next_package_index_by_slug = {}
         self.organization_by_name = {}
         self.organization_name_by_package_name = {}
-        self.package_by_name = {}
-        self.package_source_by_name = {}
+        self.package_by_name = packagestores.new_store(package_store)
+        self.package_model = {}
+        self.package_slug_by_title = {}
+        self.package_source_by_name = packagestores.new_store(package_store)
         self.packages_by_organization_name = {}
-        self.related_by_package_name = {}
+        self.packages_count_by_operation = dict(
+            created = 0,
+            deleted = 0,
+            skipped = 0,
+            updated = 0,
+            )
+        self.prefetched_organizations_id = set()
+        self.related_by_package_name = packagestores.new_store(package_store)
 
     def add_package(self, package, organization, source_name, source_url, groups = None, related = None):
         name = self.name_package(package['title'])
@@ -134,6 +230,7 @@ class Harvester(object):
 
         assert name not in self.package_by_name
         self.package_by_name[name] = package
+        self.package_model = merge_model(self.package_model, package)
 
         assert name not in self.organization_name_by_package_name
         self.organization_name_by_package_name[name] = organization['name']
@@ -147,30 +244,139 @@ class Harvester(object):
         if related:
             self.related_by_package_name[name] = related
 
+    def count_package_operation(self, operation):
+        with self.lock:
+            self.packages_count_by_operation[operation] += 1
+
+    def delete_package(self, name):
+        """Delete a package from target, by name. Deleting a missing package is not an error.
+
+        This method may be called simultaneously from several threads.
+        """
+        if self.journal is not None and self.journal.get('delete', name) is not None:
+            log.info(u'Package already deleted by resumed run: {}'.format(name))
+            return
+        log.info(u'Deleting package: {}'.format(name))
+        try:
+            # TODO: To replace with package_purge when it is available.
+            self.target_client.call('package_delete', data = dict(id = name))
+        except urllib2.HTTPError as error:
+            if error.code != 404:
+                raise
+            # Package already deleted. Do nothing.
+            log.info(u"Package to delete doesn't exist: {}".format(name))
+        else:
+            self.count_package_operation('deleted')
+        if self.snapshot is not None:
+            self.snapshot.delete_package(name)
+        if self.journal is not None:
+            self.journal.record('delete', name)
+
     def name_package(self, title):
-        for index in itertools.count(1):
+        slug = self.package_slug_by_title.get(title)
+        if slug is None:
+            slug = self.package_slug_by_title[title] = strings.slugify(title)
+        # Names are never removed from package_by_name, so the indexes below the last one returned for this slug are
+        # still taken: start from it instead of 1.
+        for index in itertools.count(self.next_package_index_by_slug.get(slug, 1)):
             differentiator = u'-{}'.format(index) if index > 1 else u''
             name = u'{}{}-{}'.format(
-                strings.slugify(title)[:100 - len(self.supplier_abbreviation) - 1 - len(differentiator)].rstrip(u'-'),
+                slug[:100 - len(self.supplier_abbreviation) - 1 - len(differentiator)].rstrip(u'-'),
                 differentiator,
                 self.supplier_abbreviation,
                 )
             if name not in self.package_by_name:
+                self.next_package_index_by_slug[slug] = index
                 return name
 
+    def report_http_metrics(self):
+        """Log the statistics of HTTP requests and write them in metrics directory (if any)."""
+        log.info(u'HTTP requests (by decreasing total time):\n{}'.format(self.http_metrics.report_to_str()))
+        if self.metrics_dir is not None:
+            self.http_metrics.write_report(self.metrics_dir, u'harvester-{}'.format(self.supplier_abbreviation))
+
+    def retrieve_groups_and_organizations(self):
+        """Retrieve in bulk all the groups & organizations of target, so that upserts can be resolved locally."""
+        self.existing_group_by_name = dict(
+            (group_json['name'], group_json)
+            for group_json in self.target_client.call('group_list', params = dict(all_fields = True))
+            )
+        self.existing_organization_by_name = dict(
+            (organization_json['name'], organization_json)
+            for organization_json in self.target_client.call('organization_list', params = dict(
+                all_fields = True,
+                # Users are needed to check that organizations have an admin.
+                include_users = self.admin_name is not None,
+                ))
+            )
+        log.info(u'Retrieved {} groups and {} organizations from target'.format(len(self.existing_group_by_name),
+            len(self.existing_organization_by_name)))
+
+    def retrieve_organization_packages(self, organization):
+        """Retrieve every package owned by an organization, using paged package_search.
+
+        The retrieved packages are added to existing_package_by_name, to avoid a package_show per upserted package.
+        Only their ID, title & fingerprint are kept in memory (in existing_package_infos_by_name). Return the names of
+        the packages.
+
+        When the snapshot has a listing of the organization, only the packages modified (or deleted) in target since
+        this listing are retrieved. The others are only in existing_package_infos_by_name.
+        """
+        infos_by_name = self.snapshot.get_organization_listing(organization['id']) \
+            if self.snapshot is not None else {}
+        if infos_by_name:
+            # Confirm the deltas: retrieve the packages modified since the listing, including the deleted ones.
+            modified_since = max(infos['metadata_modified'] for infos in infos_by_name.itervalues())[:19] + u'Z'
+            modified_packages_count = 0
+            for package in self.search_packages(u'+owner_org:{} +metadata_modified:[{} TO *]'
+                    u' +state:(active OR deleted)'.format(organization['id'], modified_since)):
+                modified_packages_count += 1
+                if package.get('state', 'active') == 'active':
+                    self.existing_package_by_name[package['name']] = package
+                    infos_by_name[package['name']] = package_to_infos(package)
+                else:
+                    infos_by_name.pop(package['name'], None)
+            # A package may also have left the organization, without being modified. Check the count of packages.
+            packages_count = self.target_client.call('package_search', params = dict(
+                fq = u'owner_org:{}'.format(organization['id']),
+                rows = 0,
+                ))['count']
+            if packages_count == len(infos_by_name):
+                log.info(u'Retrieved {} modified packages of organization (out of {}): {}'.format(
+                    modified_packages_count, packages_count, organization['name']))
+            else:
+                log.info(u'Listing of organization is obsolete ({} packages instead of {}): {}'.format(
+                    len(infos_by_name), packages_count, organization['name']))
+                infos_by_name = {}
+        if not infos_by_name:
+            for package in self.search_packages(u'owner_org:{}'.format(organization['id'])):
+                self.existing_package_by_name[package['name']] = package
+                infos_by_name[package['name']] = package_to_infos(package)
+            log.info(u'Retrieved {} existing packages of organization: {}'.format(len(infos_by_name),
+                organization['name']))
+        if self.snapshot is not None:
+            self.snapshot.set_organization_listing(organization['id'], infos_by_name)
+        for name, infos in infos_by_name.iteritems():
+            self.existing_package_infos_by_name[name] = dict(
+                fingerprint = infos['fingerprint'],
+                id = infos['id'],
+                title = infos['title'],
+                )
+        self.prefetched_organizations_id.add(organization['id'])
+        return sorted(infos_by_name)
+
     def retrieve_supplier_existing_packages(self, supplier):
-        for package in (supplier.get('packages') or []):
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/package_show?id={}'.format(package['id'])), headers = self.target_headers)
-            response = urllib2.urlopen(request)
-            response_dict = json.loads(response.read())
-            package = conv.check(
-                conv.make_ckan_json_to_package(drop_none_values = True),
-                )(response_dict['result'], state = conv.default_state)
-            if package is None:
-                continue
-            if not package['name'].startswith('jeux-de-donnees-'):
+        for package_name in self.retrieve_organization_packages(supplier):
+            if not package_name.startswith('jeux-de-donnees-'):
                 continue
+            package = self.existing_package_by_name.get(package_name)
+            if package is None:
+                # Package is unchanged since the listing of snapshot: retrieve it.
+                package = self.existing_package_by_name[package_name] = conv.check(conv.pipe(
+                    conv.make_ckan_json_to_package(drop_none_values = True),
+                    conv.not_none,
+                    ))(self.target_client.call('package_show', params = dict(id = package_name)),
+                        state = conv.default_state)
             for tag in (package.get('tags') or []):
                 if tag['name'] == 'liste-de-jeux-de-donnees':
                     break
@@ -180,7 +386,7 @@ class Harvester(object):
             self.existing_packages_name.add(package['name'])
             for resource in (package.get('resources') or []):
                 request = urllib2.Request(resource['url'], headers = self.target_headers)
-                response = urllib2.urlopen(request)
+                response = self.target_client.urlopen(request)
                 packages_csv_reader = csv.reader(response, delimiter = ';', quotechar = '"')
                 packages_csv_reader.next()
                 for row in packages_csv_reader:
@@ -191,6 +397,8 @@ class Harvester(object):
                     self.existing_packages_name.add(package_infos['name'])
 
     def retrieve_target(self):
+        self.retrieve_groups_and_organizations()
+
         # Upsert supplying organization (that will contain all harvested datasets).
         self.supplier = self.upsert_organization(dict(
             title = self.supplier_title,
@@ -199,172 +407,76 @@ class Harvester(object):
 
         if self.old_supplier_name is not None:
             # Retrieve old supplying organization.
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/organization_show?id={}'.format(self.old_supplier_name)), headers = self.target_headers)
             try:
-                response = urllib2.urlopen(request)
-            except urllib2.HTTPError as response:
-                if response.code != 404:
+                old_supplier_json = self.target_client.call('organization_show', params = dict(
+                    id = self.old_supplier_name,
+                    ))
+            except urllib2.HTTPError as error:
+                if error.code != 404:
                     raise
             else:
-                response_dict = json.loads(response.read())
                 old_supplier = conv.check(conv.pipe(
                     conv.make_ckan_json_to_organization(drop_none_values = True),
                     conv.not_none,
-                    ))(response_dict['result'], state = conv.default_state)
+                    ))(old_supplier_json, state = conv.default_state)
                 self.organization_by_name[self.old_supplier_name] = old_supplier
                 self.retrieve_supplier_existing_packages(old_supplier)
 
+    def search_packages(self, fq):
+        """Generate the packages matching a Solr filter query, using paged package_search (in name order)."""
+        start = 0
+        while True:
+            result = self.target_client.call('package_search', params = dict(
+                fq = fq,
+                rows = self.search_rows,
+                sort = 'name asc',
+                start = start,
+                ))
+            start += len(result['results'])
+            for package_json in result['results']:
+                package = conv.check(conv.make_ckan_json_to_package(drop_none_values = True))(package_json,
+                    state = conv.default_state)
+                if package is not None:
+                    yield package
+            if len(result['results']) < self.search_rows or start >= result['count']:
+                break
+
     def update_target(self):
-        # Upsert packages to target.
-        for package_name, package in self.package_by_name.iteritems():
-            log.info(u'Upserting package: {}'.format(package['title']))
-            self.existing_packages_name.discard(package_name)
-            self.upsert_package(package)
+        # Before changing anything in target, ensure that the harvest didn't lose a large part of the packages (for
+        # example because source was unavailable), since the missing packages would be deleted from target.
+        obsolete_packages_name = self.existing_packages_name.difference(self.package_by_name)
+        obsolete_packages_name.difference_update(
+            self.name_package(u'Jeux de données - {}'.format(organization['title']))
+            for organization in self.organization_by_name.itervalues()
+            )
+        max_deletions = max(self.max_deletions_min, int(self.max_deletions_ratio * len(self.existing_packages_name)))
+        if len(obsolete_packages_name) > max_deletions:
+            raise RuntimeError(u'Aborting update of target: {} packages would be deleted (max: {})'.format(
+                len(obsolete_packages_name), max_deletions))
 
-            # Read updated package.
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/package_show?id={}'.format(package_name)), headers = self.target_headers)
-            response = urllib2.urlopen(request)
-            response_dict = json.loads(response.read())
-            package = conv.check(conv.pipe(
-                conv.make_ckan_json_to_package(drop_none_values = True),
-                conv.not_none,
-                ))(response_dict['result'], state = conv.default_state)
+        if self.journals_dir is not None:
+            self.journal = journals.CheckpointJournal(self.journals_dir, resume = self.resume, run_id = self.run_id)
+
+        if self.snapshot is not None:
+            # Retrieve the packages of the organizations of harvested packages. Thanks to the listings of snapshot,
+            # only the packages modified in target since previous run are retrieved, instead of a package_show for
+            # each harvested package.
+            for organization_name, organization in sorted(self.organization_by_name.iteritems()):
+                if organization['id'] not in self.prefetched_organizations_id:
+                    self.retrieve_organization_packages(organization)
+
+        # Upsert packages to target.
+        # Packages are upserted concurrently (when thread_count > 1), but they are processed and their results are
+        # collected in name order, to keep the lists of datasets deterministic.
+        packages_name = sorted(self.package_by_name)
+        self.existing_packages_name.difference_update(packages_name)
+        for package_name, package in itertools.izip(packages_name,
+                parallel_map(self.update_target_package, packages_name, thread_count = self.thread_count)):
             self.packages_by_organization_name.setdefault(self.organization_name_by_package_name[package_name],
                 []).append(package)
 
-            # Upsert package's related links.
-            related = self.related_by_package_name.get(package_name)
-            if related:
-                # Retrieve package's related.
-                request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                    'api/3/action/related_list?id={}'.format(package_name)), headers = self.target_headers)
-                response = urllib2.urlopen(request)
-                response_dict = json.loads(response.read())
-                existing_related = conv.check(conv.pipe(
-                    conv.test_isinstance(list),
-                    conv.uniform_sequence(
-                        conv.make_ckan_json_to_related(drop_none_values = 'missing'),
-                        drop_none_items = True,
-                        ),
-                    conv.empty_to_none,
-                    ))(response_dict['result'], state = conv.default_state)
-                for related_link in related:
-                    related_link['dataset_id'] = package['id']
-                    if related_link.get('description') is None:
-                        # CKAN 2.1 displays "None" when description is missing.
-                        related_link['description'] = u''
-                    if related_link.get('url') is None:
-                        # Weckan fails when url is missing.
-                        related_link['url'] = u''
-                    for existing_related_link in (existing_related or []):
-                        if existing_related_link['title'] == related_link['title'] and (related_link.get('type') is None
-                                or existing_related_link.get('type') == related_link['type']):
-                            # Update related link.
-                            if existing_related_link.get('description') != related_link.get('description') \
-                                    or existing_related_link.get('image_url') != related_link.get('image_url') \
-                                    or existing_related_link.get('url') != related_link.get('url'):
-                                # Note: Currently, CKAN (2.1) doesn't accept that the owner of a related link updates it
-                                # (even a sysadmin can't do it). So we delete it and recreate it.
-#                                related_link['id'] = existing_related_link['id']
-#                                request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-#                                    'api/3/action/related_update?id={}'.format(related_link['id'])),
-#                                    headers = self.target_headers)
-#                                try:
-#                                    response = urllib2.urlopen(request, urllib.quote(json.dumps(related_link)))
-#                                except urllib2.HTTPError as response:
-#                                    response_text = response.read()
-#                                    log.error(u'An exception occured while updating related link: {0}'.format(
-#                                        related_link))
-#                                    try:
-#                                        response_dict = json.loads(response_text)
-#                                    except ValueError:
-#                                        log.error(response_text)
-#                                        raise
-#                                    for key, value in response_dict.iteritems():
-#                                        log.debug('{} = {}'.format(key, value))
-#                                    raise
-#                                else:
-#                                    assert response.code == 200
-#                                    response_dict = json.loads(response.read())
-#                                    assert response_dict['success'] is True
-##                                    updated_related_link = response_dict['result']
-##                                    pprint.pprint(updated_related_link)
-                                # Delete existing related link.
-                                request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                                    'api/3/action/related_delete?id={}'.format(existing_related_link['id'])),
-                                    headers = self.target_headers)
-                                try:
-                                    response = urllib2.urlopen(request, urllib.quote(json.dumps(existing_related_link)))
-                                except urllib2.HTTPError as response:
-                                    response_text = response.read()
-                                    log.error(u'An exception occured while deleting related link: {0}'.format(
-                                        existing_related_link))
-                                    try:
-                                        response_dict = json.loads(response_text)
-                                    except ValueError:
-                                        log.error(response_text)
-                                        raise
-                                    for key, value in response_dict.iteritems():
-                                        log.debug('{} = {}'.format(key, value))
-                                    raise
-                                else:
-                                    assert response.code == 200
-                                    response_dict = json.loads(response.read())
-                                    assert response_dict['success'] is True
-                                # Recreate related link.
-                                request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                                    'api/3/action/related_create'), headers = self.target_headers)
-                                try:
-                                    response = urllib2.urlopen(request, urllib.quote(json.dumps(related_link)))
-                                except urllib2.HTTPError as response:
-                                    response_text = response.read()
-                                    log.error(u'An exception occured while creating related link: {0}'.format(
-                                        related_link))
-                                    try:
-                                        response_dict = json.loads(response_text)
-                                    except ValueError:
-                                        log.error(response_text)
-                                        raise
-                                    for key, value in response_dict.iteritems():
-                                        log.debug('{} = {}'.format(key, value))
-                                    raise
-                                else:
-                                    assert response.code == 200
-                                    response_dict = json.loads(response.read())
-                                    assert response_dict['success'] is True
-#                                    created_related_link = response_dict['result']
-#                                    pprint.pprint(created_related_link)
-#                                    related_link['id'] = created_related_link['id']
-                            break
-                    else:
-                        # Create related link.
-                        request = urllib2.Request(urlparse.urljoin(self.target_site_url, 'api/3/action/related_create'),
-                            headers = self.target_headers)
-                        try:
-                            response = urllib2.urlopen(request, urllib.quote(json.dumps(related_link)))
-                        except urllib2.HTTPError as response:
-                            response_text = response.read()
-                            log.error(u'An exception occured while creating related link: {0}'.format(related_link))
-                            try:
-                                response_dict = json.loads(response_text)
-                            except ValueError:
-                                log.error(response_text)
-                                raise
-                            for key, value in response_dict.iteritems():
-                                log.debug('{} = {}'.format(key, value))
-                            raise
-                        else:
-                            assert response.code == 200
-                            response_dict = json.loads(response.read())
-                            assert response_dict['success'] is True
-#                            created_related_link = response_dict['result']
-#                            pprint.pprint(created_related_link)
-#                            related_link['id'] = created_related_link['id']
-
         # Upsert lists of harvested packages into target.
-        for organization_name, organization in self.organization_by_name.iteritems():
+        for organization_name, organization in sorted(self.organization_by_name.iteritems()):
             package_title = u'Jeux de données - {}'.format(organization['title'])
             package_name = self.name_package(package_title)
             self.existing_packages_name.discard(package_name)
@@ -388,8 +500,27 @@ class Harvester(object):
                         package_source['name'].encode('utf-8'),
                         package_source['url'].encode('utf-8'),
                         ])
-                file_metadata = filestores.upload_file(self.target_site_url, package_name,
-                    packages_file.getvalue(), self.target_headers)
+                packages_csv = packages_file.getvalue()
+                packages_fingerprint = hashlib.sha1(packages_csv).hexdigest()
+                if self.journal is not None \
+                        and self.journal.get('list', package_name, packages_fingerprint) is not None:
+                    log.info(u'List of packages already upserted by resumed run: {}'.format(package_name))
+                    continue
+                existing_resources = (self.existing_package_by_name.get(package_name) or {}).get('resources') or []
+                if len(existing_resources) == 1 and checksum_matches(packages_csv, existing_resources[0].get('hash')):
+                    # List is unchanged: keep the file already uploaded.
+                    log.info(u'List of packages is unchanged: {}'.format(package_name))
+                    existing_resource = existing_resources[0]
+                    file_metadata = dict(
+                        _checksum = existing_resource['hash'],
+                        _content_length = existing_resource.get('size'),
+                        _creation_date = existing_resource.get('created'),
+                        _last_modified = existing_resource.get('last_modified'),
+                        _location = existing_resource['url'],
+                        )
+                else:
+                    file_metadata = filestores.upload_file(self.target_site_url, package_name, packages_csv,
+                        self.target_headers)
 
                 if self.supplier == organization:
                     notes = u'''\
@@ -433,54 +564,104 @@ class Harvester(object):
                     title = package_title,
                     )
                 self.upsert_package(package)
+                if self.journal is not None:
+                    self.journal.record('list', package_name, packages_fingerprint)
             else:
                 # Delete dataset if it exists.
-                log.info(u'Deleting package: {}'.format(package_name))
+                self.existing_packages_name.add(package_name)
 
-                # Retrieve package id (needed for delete).
-                request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                    'api/3/action/package_show?id={}'.format(package_name)), headers = self.target_headers)
-                try:
-                    response = urllib2.urlopen(request)
-                except urllib2.HTTPError as response:
-                    if response.code != 404:
-                        raise
-                    # Package already deleted. Do nothing.
-                    log.warning(u"Package to delete doesn't exist: {}".format(package_name))
-                else:
-                    response_dict = json.loads(response.read())
-                    existing_package = response_dict['result']
+        # Delete obsolete packages.
+        parallel_map(self.delete_package, sorted(self.existing_packages_name), thread_count = self.thread_count)
 
-                    # TODO: To replace with package_purge when it is available.
-                    request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                        'api/3/action/package_delete?id={}'.format(package_name)), headers = self.target_headers)
-                    response = urllib2.urlopen(request, urllib.quote(json.dumps(existing_package)))
-                    response_dict = json.loads(response.read())
-#                    deleted_package = response_dict['result']
-#                    pprint.pprint(deleted_package)
+        if self.journal is not None:
+            self.journal.finish()
+        log.info(u'Target packages: {created} created, {updated} updated, {skipped} unchanged, {deleted} deleted'
+            .format(**self.packages_count_by_operation))
+        log.info(u'Target HTTP connections: {}'.format(self.target_client.http_client.statistics_to_str()))
+        log.info(u'Target write rate: {:.2f} requests per second'.format(self.target_client.rate_limiter.rate))
 
-        # Delete obsolete packages.
-        for package_name in self.existing_packages_name:
-            # Retrieve package id (needed for delete).
-            log.info(u'Deleting package: {}'.format(package_name))
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/package_show?id={}'.format(package_name)), headers = self.target_headers)
-            try:
-                response = urllib2.urlopen(request)
-            except urllib2.HTTPError as response:
-                if response.code != 404:
-                    raise
-                # Package already deleted. Do nothing.
-            else:
-                response_dict = json.loads(response.read())
-                existing_package = response_dict['result']
+    def update_target_package(self, package_name):
+        """Upsert a harvested package and its related links into target and return the ID, name & title of package.
+
+        This method may be called simultaneously from several threads.
+        """
+        package = self.package_by_name[package_name]
+        journal_entry = None
+        if self.journal is not None:
+            package_fingerprint = fingerprint(canonicalize(package))
+            journal_entry = self.journal.get('package', package_name, package_fingerprint)
+        if journal_entry is not None:
+            log.info(u'Package already upserted by resumed run: {}'.format(package_name))
+            package = journal_entry['result']
+        else:
+            log.info(u'Upserting package: {}'.format(package['title']))
+            package = self.upsert_package(package)
+
+        if self.verify_target and journal_entry is None:
+            # Read updated package.
+            read_package = conv.check(conv.pipe(
+                conv.make_ckan_json_to_package(drop_none_values = True),
+                conv.not_none,
+                ))(self.target_client.call('package_show', params = dict(id = package_name)),
+                    state = conv.default_state)
+            if fingerprint(canonicalize(read_package, package)) != fingerprint(canonicalize(package)):
+                log.warning(u'Package read from target differs from upsert result: {}'.format(package_name))
+            package = read_package
+        # Keep only what is needed afterwards, so that memory doesn't grow with the upserted packages.
+        package = dict(
+            id = package['id'],
+            name = package['name'],
+            title = package['title'],
+            )
+        if self.journal is not None and journal_entry is None:
+            self.journal.record('package', package_name, package_fingerprint, result = package)
+
+        # Upsert package's related links.
+        related = self.related_by_package_name.get(package_name)
+        if related:
+            for related_link in related:
+                related_link['dataset_id'] = package['id']
+                if related_link.get('description') is None:
+                    # CKAN 2.1 displays "None" when description is missing.
+                    related_link['description'] = u''
+                if related_link.get('url') is None:
+                    # Weckan fails when url is missing.
+                    related_link['url'] = u''
+            related_fingerprint = fingerprint(canonicalize(related, ordered = True))
+            if self.snapshot is not None \
+                    and self.snapshot.get_related_fingerprint(package_name) == related_fingerprint:
+                # Related links are unchanged since previous harvest (and package ID is the same).
+                return package
+            if self.journal is not None and self.journal.get('related', package_name, related_fingerprint) is not None:
+                # Related links have already been updated by resumed run.
+                return package
 
-                request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                    'api/3/action/package_delete?id={}'.format(package_name)), headers = self.target_headers)
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(existing_package)))
-                response_dict = json.loads(response.read())
-#                deleted_package = response_dict['result']
-#                pprint.pprint(deleted_package)
+            # Retrieve package's related.
+            existing_related = conv.check(conv.pipe(
+                conv.test_isinstance(list),
+                conv.uniform_sequence(
+                    conv.make_ckan_json_to_related(drop_none_values = 'missing'),
+                    drop_none_items = True,
+                    ),
+                conv.empty_to_none,
+                ))(self.target_client.call('related_list', params = dict(id = package_name)),
+                    state = conv.default_state)
+
+            # Note: Currently, CKAN (2.1) doesn't accept that the owner of a related link updates it (even a sysadmin
+            # can't do it). So a modified related link is deleted and recreated.
+            related_links_to_delete, related_links_to_create = plan_related_links_changes(related,
+                existing_related or [])
+            for existing_related_link in related_links_to_delete:
+                self.target_client.call('related_delete', params = dict(id = existing_related_link['id']),
+                    data = existing_related_link)
+            for related_link in related_links_to_create:
+                self.target_client.call('related_create', data = related_link)
+            if self.snapshot is not None:
+                self.snapshot.set_related_fingerprint(package_name, related_fingerprint)
+            if self.journal is not None:
+                self.journal.record('related', package_name, related_fingerprint)
+
+        return package
 
     def upsert_group(self, group):
         name = strings.slugify(group['title'])[:100]
@@ -495,26 +676,32 @@ class Harvester(object):
         else:
             assert group['name'] == name, group
 
-        request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-            'api/3/action/group_show?id={}'.format(name)), headers = self.target_headers)
+        if self.existing_group_by_name is not None:
+            existing_group_json = self.existing_group_by_name.get(name)
+            if existing_group_json is not None and is_up_to_date(group, existing_group_json):
+                # Group is already up to date in target.
+                group_infos = group
+                group = existing_group_json.copy()
+                group.update(
+                    (key, value)
+                    for key, value in group_infos.iteritems()
+                    if value is not None
+                    )
+                self.group_by_name[name] = group
+                return group
+
+        # Group differs or is missing from the bulk retrieval (it may exist, but be deleted): retrieve it fully.
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as response:
-            if response.code != 404:
+            existing_group_json = self.target_client.call('group_show', params = dict(id = name))
+        except urllib2.HTTPError as error:
+            if error.code != 404:
                 raise
             existing_group = {}
         else:
-            response_text = response.read()
-            try:
-                response_dict = json.loads(response_text)
-            except ValueError:
-                log.error(u'An exception occured while reading group: {0}'.format(name))
-                log.error(response_text)
-                raise
             existing_group = conv.check(conv.pipe(
                 conv.make_ckan_json_to_group(drop_none_values = True),
                 conv.not_none,
-                ))(response_dict['result'], state = conv.default_state)
+                ))(existing_group_json, state = conv.default_state)
 
             group_infos = group
             group = conv.check(conv.ckan_input_group_to_output_group)(existing_group, state = conv.default_state)
@@ -526,54 +713,14 @@ class Harvester(object):
 
         if existing_group.get('id') is None:
             # Create group.
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url, 'api/3/action/group_create'),
-                headers = self.target_headers)
-            try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(group)))
-            except urllib2.HTTPError as response:
-                response_text = response.read()
-                log.error(u'An exception occured while creating group: {0}'.format(group))
-                try:
-                    response_dict = json.loads(response_text)
-                except ValueError:
-                    log.error(response_text)
-                    raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
-            else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-                created_group = response_dict['result']
-#                pprint.pprint(created_group)
-                group['id'] = created_group['id']
+            created_group = self.target_client.call('group_create', data = group)
+            group['id'] = created_group['id']
         else:
             # Update group.
             group['id'] = existing_group['id']
             group['state'] = 'active'
 
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/group_update?id={}'.format(name)), headers = self.target_headers)
-            try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(group)))
-            except urllib2.HTTPError as response:
-                response_text = response.read()
-                log.error(u'An exception occured while updating group: {0}'.format(group))
-                try:
-                    response_dict = json.loads(response_text)
-                except ValueError:
-                    log.error(response_text)
-                    raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
-            else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-#                updated_group = response_dict['result']
-#                pprint.pprint(updated_group)
+            self.target_client.call('group_update', params = dict(id = name), data = group)
 
         self.group_by_name[name] = group
         return group
@@ -591,26 +738,34 @@ class Harvester(object):
         else:
             assert organization['name'] == name, organization
 
-        request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-            'api/3/action/organization_show?id={}'.format(name)), headers = self.target_headers)
+        if self.existing_organization_by_name is not None:
+            existing_organization_json = self.existing_organization_by_name.get(name)
+            if existing_organization_json is not None and is_up_to_date(organization, existing_organization_json) \
+                    and (self.admin_name is None or existing_organization_json.get('users') is not None
+                        and not is_admin_needed(existing_organization_json['users'])):
+                # Organization (including its users, when admin_name is set) is already up to date in target.
+                organization_infos = organization
+                organization = existing_organization_json.copy()
+                organization.update(
+                    (key, value)
+                    for key, value in organization_infos.iteritems()
+                    if value is not None
+                    )
+                self.organization_by_name[name] = organization
+                return organization
+
+        # Organization differs, needs an admin or is missing from the bulk retrieval: retrieve it fully.
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as response:
-            if response.code != 404:
+            existing_organization_json = self.target_client.call('organization_show', params = dict(id = name))
+        except urllib2.HTTPError as error:
+            if error.code != 404:
                 raise
             existing_organization = {}
         else:
-            response_text = response.read()
-            try:
-                response_dict = json.loads(response_text)
-            except ValueError:
-                log.error(u'An exception occured while reading organization: {0}'.format(name))
-                log.error(response_text)
-                raise
             existing_organization = conv.check(conv.pipe(
                 conv.make_ckan_json_to_organization(drop_none_values = True),
                 conv.not_none,
-                ))(response_dict['result'], state = conv.default_state)
+                ))(existing_organization_json, state = conv.default_state)
 
             organization_infos = organization
             organization = conv.check(conv.ckan_input_organization_to_output_organization)(existing_organization,
@@ -626,119 +781,76 @@ class Harvester(object):
             users = organization.get('users')
             if users is None:
                 organization['users'] = users = []
-            if not users:
-                users.append(dict(
-                    capacity = 'admin',
-                    name = self.admin_name,
-                    ))
-            elif len(users) == 1 and users[0]['name'] == 'etalabot':
-                users[0] = dict(
-                    capacity = 'admin',
-                    name = self.admin_name,
-                    )
+            if is_admin_needed(users):
+                users[:] = [
+                    dict(
+                        capacity = 'admin',
+                        name = self.admin_name,
+                        ),
+                    ]
 
         if existing_organization.get('id') is None:
             # Create organization.
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url, 'api/3/action/organization_create'),
-                headers = self.target_headers)
-            try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(organization)))
-            except urllib2.HTTPError as response:
-                response_text = response.read()
-                log.error(u'An exception occured while creating organization: {0}'.format(organization))
-                try:
-                    response_dict = json.loads(response_text)
-                except ValueError:
-                    log.error(response_text)
-                    raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
-            else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-                created_organization = response_dict['result']
-#                pprint.pprint(created_organization)
-                organization['id'] = created_organization['id']
+            created_organization = self.target_client.call('organization_create', data = organization)
+            organization['id'] = created_organization['id']
         else:
             # Update organization.
             organization['id'] = existing_organization['id']
             organization['state'] = 'active'
 
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/organization_update?id={}'.format(name)), headers = self.target_headers)
-            try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(organization)))
-            except urllib2.HTTPError as response:
-                response_text = response.read()
-                log.error(u'An exception occured while updating organization: {0}'.format(organization))
-                try:
-                    response_dict = json.loads(response_text)
-                except ValueError:
-                    log.error(response_text)
-                    raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
-            else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-#                updated_organization = response_dict['result']
-#                pprint.pprint(updated_organization)
+            self.target_client.call('organization_update', params = dict(id = name), data = organization)
 
         self.organization_by_name[name] = organization
         return organization
 
     def upsert_package(self, package):
+        """Create or update a package in target and return it, as returned by CKAN.
+
+        When the package is unchanged since previous harvest (according to snapshot), only its ID, name & title are
+        returned.
+        """
         name = package.get('name')
         assert name is not None, package
+        package_fingerprint = fingerprint(canonicalize(package))
 
-        request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-            'api/3/action/package_show?id={}'.format(name)), headers = self.target_headers)
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as response:
-            if response.code != 404:
-                raise
-            existing_package = {}
-        else:
-            response_text = response.read()
-            try:
-                response_dict = json.loads(response_text)
-            except ValueError:
-                log.error(u'An exception occured while reading package: {0}'.format(package))
-                log.error(response_text)
-                raise
-            existing_package = conv.check(conv.pipe(
-                conv.make_ckan_json_to_package(drop_none_values = True),
-                conv.not_none,
-                ))(response_dict['result'], state = conv.default_state)
-        if existing_package.get('id') is None:
-            # Create package.
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url, 'api/3/action/package_create'),
-                headers = self.target_headers)
+        existing_package_infos = self.existing_package_infos_by_name.get(name)
+        # The snapshot is trusted only for the packages listed in target (by retrieve_organization_packages), so that a
+        # package deleted or edited in target is restored.
+        if existing_package_infos is not None and self.snapshot is not None and self.snapshot.is_package_unchanged(
+                name, package_fingerprint, existing_package_infos['fingerprint']):
+            log.info(u'Package is unchanged since previous harvest: {}'.format(name))
+            self.count_package_operation('skipped')
+            return dict(
+                id = existing_package_infos['id'],
+                name = name,
+                title = existing_package_infos['title'],
+                )
+        existing_package = self.existing_package_by_name.get(name) if existing_package_infos is not None else None
+        if existing_package is None:
+            # Package has not been prefetched (it doesn't belong to supplier, is deleted or doesn't exist yet).
             try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(package)))
-            except urllib2.HTTPError as response:
-                response_text = response.read()
-                log.error(u'An exception occured while creating package: {0}'.format(package))
-                try:
-                    response_dict = json.loads(response_text)
-                except ValueError:
-                    log.error(response_text)
+                existing_package_json = self.target_client.call('package_show', params = dict(id = name))
+            except urllib2.HTTPError as error:
+                if error.code != 404:
                     raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
+                existing_package = {}
             else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-                created_package = response_dict['result']
-#                pprint.pprint(created_package)
-                package['id'] = created_package['id']
+                existing_package = conv.check(conv.pipe(
+                    conv.make_ckan_json_to_package(drop_none_values = True),
+                    conv.not_none,
+                    ))(existing_package_json, state = conv.default_state)
+        if existing_package.get('id') is None:
+            # Create package.
+            created_package = conv.check(conv.pipe(
+                conv.make_ckan_json_to_package(drop_none_values = True),
+                conv.not_none,
+                ))(self.target_client.call('package_create', data = package), state = conv.default_state)
+            package['id'] = created_package['id']
+            self.count_package_operation('created')
+            if self.snapshot is not None:
+                self.snapshot.set_package(name, package_fingerprint,
+                    fingerprint(canonicalize(created_package)))
+            return created_package
         else:
             # Update package.
             package['id'] = existing_package['id']
@@ -761,28 +873,135 @@ class Harvester(object):
                 else:
                     package['groups'] = existing_groups
 
-            request = urllib2.Request(urlparse.urljoin(self.target_site_url,
-                'api/3/action/package_update?id={}'.format(name)), headers = self.target_headers)
-            try:
-                response = urllib2.urlopen(request, urllib.quote(json.dumps(package)))
-            except urllib2.HTTPError as response:
-                response_text = response.read()
-                log.error(u'An exception occured while updating package: {0}'.format(package))
-                try:
-                    response_dict = json.loads(response_text)
-                except ValueError:
-                    log.error(response_text)
-                    raise
-                for key, value in response_dict.iteritems():
-                    log.debug('{} = {}'.format(key, value))
-                raise
-            else:
-                assert response.code == 200
-                response_dict = json.loads(response.read())
-                assert response_dict['success'] is True
-#                updated_package = response_dict['result']
-#                pprint.pprint(updated_package)
-        return package
+            # Compare the fields of package & the fields that harvester gives to other packages, so that a field dropped
+            # by source (and thus cleared by package_update) is not ignored.
+            if fingerprint(canonicalize(package)) == fingerprint(canonicalize(existing_package,
+                    merge_model(self.package_model, package))):
+                # Package has not changed since last harvest. Don't update it, to spare CKAN (reindexing, revisions).
+                log.info(u'Package is unchanged: {}'.format(name))
+                self.count_package_operation('skipped')
+                if self.snapshot is not None:
+                    self.snapshot.set_package(name, package_fingerprint,
+                        fingerprint(canonicalize(existing_package)))
+                return existing_package
+
+            updated_package = conv.check(conv.pipe(
+                conv.make_ckan_json_to_package(drop_none_values = True),
+                conv.not_none,
+                ))(self.target_client.call('package_update', params = dict(id = name), data = package),
+                    state = conv.default_state)
+            self.count_package_operation('updated')
+            if self.snapshot is not None:
+                self.snapshot.set_package(name, package_fingerprint,
+                    fingerprint(canonicalize(updated_package)))
+            return updated_package
+
+
+def add_target_arguments(parser):
+    """Add to an argparse parser the command line options tuning the update of target CKAN (& source requests)."""
+    parser.add_argument('-c', '--thread-count', default = 1, help = 'max number of threads updating target CKAN',
+        type = int)
+    parser.add_argument('--cassette-dir',
+        help = 'directory where responses of source sites are recorded or replayed (see --cassette-mode)')
+    parser.add_argument('--cassette-mode', choices = cassettes.modes, default = 'replay',
+        help = 'record responses of source sites into cassette directory or replay them from it, without network')
+    parser.add_argument('--max-deletions-ratio', default = 0.5,
+        help = 'max ratio of existing packages that can be deleted, above which update of CKAN is aborted',
+        type = float)
+    parser.add_argument('--metrics-dir',
+        help = 'directory where a report of HTTP requests is written (as JSON & as Prometheus textfile)')
+    parser.add_argument('--package-store', choices = packagestores.stores_kind, default = 'memory',
+        help = 'where to keep harvested packages until the update of target (on disk to harvest in bounded memory)')
+    parser.add_argument('--resume', action = 'store_true',
+        help = 'resume the latest interrupted run (or the run given by --run-id), skipping the operations it did')
+    parser.add_argument('--run-id', help = 'ID of run, naming its journal in state directory (default: current time)')
+    parser.add_argument('--source-cache-dir',
+        help = 'directory where responses of source sites are cached, to download them only when they are modified')
+    parser.add_argument('--state-dir',
+        help = 'directory where to keep a snapshot of target CKAN & the journal of the run, to speed up next harvests')
+    parser.add_argument('--target-deadline',
+        help = 'max duration (in seconds) of the run, after which no request is sent to target CKAN', type = float)
+    parser.add_argument('--target-max-latency', default = 2,
+        help = 'latency (in seconds) above which target CKAN is considered overloaded and writes are slowed down',
+        type = float)
+    parser.add_argument('--target-max-write-rate', default = 50,
+        help = 'max number of write requests per second sent to target CKAN (shared by all threads)', type = float)
+    parser.add_argument('--target-timeout', default = 60,
+        help = 'timeout (in seconds) of each request sent to target CKAN', type = float)
+    parser.add_argument('--verify-target', action = 'store_true',
+        help = 'read back every upserted package from target CKAN and check it')
+
+
+def canonicalize(value, model = None, ordered = False):
+    """Convert a JSON-like value to a canonical form, suitable for fingerprinting.
+
+    None values, empty strings & empty collections are removed, numbers are converted to strings and, unless ordered
+    is true, lists are sorted (only the order of resources is meaningful).
+
+    When a model is given, dicts keep only the keys existing in model. This allows to compare a package sent to CKAN
+    with the package returned by CKAN, which contains many more (generated) fields.
+    """
+    if isinstance(value, dict):
+        if isinstance(model, dict):
+            items = (
+                (key, canonicalize(value.get(key), model = model[key], ordered = key in ordered_keys))
+                for key in model
+                )
+        else:
+            items = (
+                (key, canonicalize(item, ordered = key in ordered_keys))
+                for key, item in value.iteritems()
+                )
+        return dict(
+            (key, item)
+            for key, item in items
+            if item is not None
+            ) or None
+    if isinstance(value, (list, tuple)):
+        item_model = None
+        if isinstance(model, (list, tuple)):
+            # Items of a list share the same model: the union of the keys of model items.
+            for model_item in model:
+                if isinstance(model_item, dict):
+                    if item_model is None:
+                        item_model = {}
+                    for key, model_value in model_item.iteritems():
+                        if item_model.get(key) is None:
+                            item_model[key] = model_value
+        items = [
+            item
+            for item in (
+                canonicalize(item, model = item_model)
+                for item in value
+                )
+            if item is not None
+            ]
+        if not ordered:
+            items.sort(key = fingerprint)
+        return items or None
+    if isinstance(value, basestring):
+        return value or None
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return unicode(value)
+    return value
+
+
+def checksum_matches(content, checksum):
+    """Return whether a checksum of filestore ("md5:<hex digest>" or "<algorithm>:<hex digest>") matches content."""
+    if not checksum:
+        return False
+    algorithm, separator, digest = checksum.rpartition(':')
+    try:
+        return hashlib.new(str(algorithm or 'md5'), content).hexdigest() == digest.lower()
+    except ValueError:
+        # Unknown hash algorithm
+        return False
+
+
+def fingerprint(value):
+    """Return a hash of the JSON form of a value. Use canonicalize() first to compare packages sent to & read from CKAN.
+    """
+    return hashlib.sha1(json.dumps(value, ensure_ascii = True, separators = (',', ':'), sort_keys = True)).hexdigest()
 
 
 def get_extra(instance, key, default = UnboundLocalError):
@@ -794,6 +1013,185 @@ def get_extra(instance, key, default = UnboundLocalError):
     return default
 
 
+def is_admin_needed(users):
+    """Return whether the admin of harvester must be given to an organization with these users."""
+    return not users or len(users) == 1 and users[0]['name'] == 'etalabot'
+
+
+def is_up_to_date(infos, existing_json):
+    """Return whether an active group or organization of target already has the (non None) values of infos."""
+    return existing_json.get('state', 'active') == 'active' and all(
+        existing_json.get(key) == value
+        for key, value in infos.iteritems()
+        if value is not None
+        )
+
+
+def iter_parallel_map(function, items, thread_count = 1):
+    """Generate the result of function for every item, in items order, computing up to thread_count results ahead of
+    the consumer in as many threads.
+
+    Unlike parallel_map, results are generated as soon as they are available (in order) and at most thread_count of
+    them are kept waiting to be consumed. The first exception raised by function is re-raised when its result is due.
+    """
+    items = iter(items)
+    if thread_count <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    tasks = Queue.Queue()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            item, slot = task
+            try:
+                slot.put((function(item), None))
+            except:
+                slot.put((None, sys.exc_info()))
+
+    threads = [
+        threading.Thread(target = work)
+        for index in range(thread_count)
+        ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        slots = collections.deque()
+        for item in itertools.islice(items, thread_count):
+            slot = Queue.Queue(1)
+            tasks.put((item, slot))
+            slots.append(slot)
+        while slots:
+            slot = slots.popleft()
+            while True:
+                try:
+                    # Get with a timeout, to let the main thread handle KeyboardInterrupt.
+                    result, error = slot.get(True, 1)
+                except Queue.Empty:
+                    continue
+                break
+            if error is not None:
+                error_class, error, traceback = error
+                raise error_class, error, traceback
+            for item in itertools.islice(items, 1):
+                slot = Queue.Queue(1)
+                tasks.put((item, slot))
+                slots.append(slot)
+            yield result
+    finally:
+        # Stop the threads once their current call is over (even when the consumer stops early).
+        for thread in threads:
+            tasks.put(None)
+
+
+def merge_model(model, value):
+    """Return a model (see canonicalize) having the keys of both model & value (at every level)."""
+    if isinstance(value, dict):
+        model = model.copy() if isinstance(model, dict) else {}
+        for key, item in value.iteritems():
+            model[key] = merge_model(model.get(key), item)
+        return model
+    if isinstance(value, (list, tuple)):
+        # Items of a list share the same model.
+        item_model = model[0] if isinstance(model, list) and model else None
+        for item in value:
+            item_model = merge_model(item_model, item)
+        return [item_model] if item_model is not None else []
+    return model if model is not None else True
+
+
+def package_to_infos(package):
+    """Return the infos of a package of target kept by the listing of an organization (see TargetSnapshot)."""
+    return dict(
+        fingerprint = fingerprint(canonicalize(package)),
+        id = package['id'],
+        metadata_modified = package.get('metadata_modified') or u'1970-01-01T00:00:00',
+        title = package['title'],
+        )
+
+
+def parallel_map(function, items, thread_count = 1):
+    """Apply function to every item, using up to thread_count threads, and return the results in items order.
+
+    The first exception raised by function is re-raised once all running calls are over.
+    """
+    items = list(items)
+    if thread_count <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    errors = []
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+    results = [None] * len(items)
+
+    def work():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except:
+                errors.append(sys.exc_info())
+
+    threads = [
+        threading.Thread(target = work)
+        for index in range(min(thread_count, len(items)))
+        ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            # Join with a timeout, to let the main thread handle KeyboardInterrupt.
+            thread.join(1)
+    if errors:
+        error_class, error, traceback = errors[0]
+        raise error_class, error, traceback
+    return results
+
+
+def plan_related_links_changes(related, existing_related):
+    """Compare the harvested related links of a package with its existing ones and return the lists of existing
+    related links to delete & of related links to create.
+
+    A related link matches the first existing related link with the same title and, when it has one, the same type.
+    """
+    existing_related_link_by_title = {}
+    existing_related_link_by_title_and_type = {}
+    for existing_related_link in existing_related:
+        existing_related_link_by_title.setdefault(existing_related_link['title'], existing_related_link)
+        existing_related_link_by_title_and_type.setdefault(
+            (existing_related_link['title'], existing_related_link.get('type')), existing_related_link)
+
+    related_links_to_create = []
+    related_links_to_delete = []
+    deleted_related_links_id = set()
+    for related_link in related:
+        if related_link.get('type') is None:
+            existing_related_link = existing_related_link_by_title.get(related_link['title'])
+        else:
+            existing_related_link = existing_related_link_by_title_and_type.get(
+                (related_link['title'], related_link['type']))
+        if existing_related_link is None:
+            related_links_to_create.append(related_link)
+        elif existing_related_link.get('description') != related_link.get('description') \
+                or existing_related_link.get('image_url') != related_link.get('image_url') \
+                or existing_related_link.get('url') != related_link.get('url'):
+            if existing_related_link['id'] not in deleted_related_links_id:
+                deleted_related_links_id.add(existing_related_link['id'])
+                related_links_to_delete.append(existing_related_link)
+            related_links_to_create.append(related_link)
+    return related_links_to_delete, related_links_to_create
+
+
 def pop_extra(instance, key, default = UnboundLocalError):
     for index, extra in enumerate(instance.get('extras') or []):
         if extra['key'] == key:
@@ -818,3 +1216,24 @@ def set_extra(instance, key, value):
         key = key,
         value = value,
         ))
+
+
+def target_options(args):
+    """Convert the options added by add_target_arguments to keyword arguments for Harvester."""
+    return dict(
+        cassette_dir = args.cassette_dir,
+        cassette_mode = args.cassette_mode,
+        max_deletions_ratio = args.max_deletions_ratio,
+        metrics_dir = args.metrics_dir,
+        package_store = args.package_store,
+        resume = args.resume,
+        run_id = args.run_id,
+        source_cache_dir = args.source_cache_dir,
+        state_dir = args.state_dir,
+        target_deadline = args.target_deadline,
+        target_max_latency = args.target_max_latency,
+        target_max_write_rate = args.target_max_write_rate,
+        target_timeout = args.target_timeout,
+        thread_count = args.thread_count,
+        verify_target = args.verify_target,
+        )
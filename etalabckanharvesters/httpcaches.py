@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Persistent cache of the responses of source sites, revalidated with conditional GET requests
+
+The body of every successful GET response having an ETag or a Last-Modified header is stored in a cache directory.
+The next request of the same URL is sent with If-None-Match & If-Modified-Since headers and, when the source site
+answers "304 Not Modified", the response is served from the cache.
+"""
+
+
+import cStringIO
+import hashlib
+import httplib
+import json
+import logging
+import os
+import urllib
+import urllib2
+import urlparse
+
+
+log = logging.getLogger(__name__)
+
+
+class ConditionalCacheHandler(urllib2.BaseHandler):
+    """urllib2 handler caching responses and revalidating them with conditional requests"""
+    dir_path = None
+    excluded_hosts = None  # Hosts (netloc) whose responses are not cached
+    handler_order = 300  # Process responses after httpmetrics.MetricsHandler, but before cassettes.CassetteHandler.
+    hits_count = 0  # Number of responses served from cache (after a 304)
+
+    def __init__(self, dir_path, excluded_hosts = None):
+        self.dir_path = dir_path
+        self.excluded_hosts = set(excluded_hosts or [])
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+    def get_file_path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.dir_path, hashlib.sha1(url).hexdigest())
+
+    def http_request(self, request):
+        if not self.is_cacheable(request):
+            return request
+        metadata = self.load_metadata(request.get_full_url())
+        if metadata is not None:
+            if metadata.get('etag') and not request.has_header('If-none-match'):
+                request.add_unredirected_header('If-None-Match', metadata['etag'])
+            if metadata.get('last_modified') and not request.has_header('If-modified-since'):
+                request.add_unredirected_header('If-Modified-Since', metadata['last_modified'])
+        return request
+
+    def http_response(self, request, response):
+        if not self.is_cacheable(request):
+            return response
+        url = request.get_full_url()
+        file_path = self.get_file_path(url)
+        if response.code == 304:
+            metadata = self.load_metadata(url)
+            if metadata is None:
+                return response
+            try:
+                with open(file_path + '.body', 'rb') as body_file:
+                    body = body_file.read()
+            except IOError:
+                return response
+            log.debug(u'Source response not modified, using cache: {}'.format(url))
+            self.hits_count += 1
+            headers = httplib.HTTPMessage(cStringIO.StringIO(metadata['headers'].encode('latin-1')))
+            cached_response = urllib.addinfourl(cStringIO.StringIO(body), headers, response.geturl(), 200)
+            cached_response.msg = 'OK'
+            return cached_response
+        if response.code != 200:
+            return response
+        etag = response.info().get('ETag')
+        last_modified = response.info().get('Last-Modified')
+        if not etag and not last_modified:
+            return response
+        body = response.read()
+        write_atomically(file_path + '.body', body)
+        write_atomically(file_path + '.json', json.dumps(dict(
+            etag = etag,
+            headers = ''.join(response.info().headers).decode('latin-1'),
+            last_modified = last_modified,
+            url = url.decode('utf-8') if isinstance(url, str) else url,
+            ), sort_keys = True))
+        # The body has been consumed: return a new response reading it again.
+        stored_response = urllib.addinfourl(cStringIO.StringIO(body), response.info(), response.geturl(),
+            response.code)
+        stored_response.msg = response.msg
+        return stored_response
+
+    def is_cacheable(self, request):
+        return request.get_method() == 'GET' \
+            and urlparse.urlsplit(request.get_full_url()).netloc not in self.excluded_hosts
+
+    def load_metadata(self, url):
+        try:
+            with open(self.get_file_path(url) + '.json') as metadata_file:
+                return json.load(metadata_file)
+        except (IOError, ValueError):
+            return None
+
+    https_request = http_request
+    https_response = http_response
+
+
+def write_atomically(file_path, data):
+    temporary_file_path = file_path + '.tmp'
+    with open(temporary_file_path, 'wb') as output_file:
+        output_file.write(data)
+    os.rename(temporary_file_path, file_path)
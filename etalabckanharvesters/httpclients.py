@@ -0,0 +1,237 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""HTTP client reusing persistent (keep-alive) connections
+
+Unlike urllib2, which opens a new connection for every request, this client keeps idle connections in a pool (per
+scheme, host & port), so that the thousands of requests sent to the target CKAN during a harvest don't pay the cost
+of a TCP (& TLS) handshake each.
+"""
+
+
+import cStringIO
+import errno
+import httplib
+import logging
+import select
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+
+idempotent_methods = ('DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE')
+log = logging.getLogger(__name__)
+redirect_codes = (301, 302, 303, 307)
+
+
+class PooledHttpClient(object):
+    """HTTP client mimicking urllib2.urlopen, but keeping connections alive. It can be shared between threads."""
+    connection_class_by_scheme = dict(
+        http = httplib.HTTPConnection,
+        https = httplib.HTTPSConnection,
+        )
+    connections_count = 0  # Number of connections opened
+    idle_connections_by_key = None
+    lock = None
+    max_idle_connections = 10  # Maximum number of idle connections kept for each host
+    max_redirections = 10
+    metrics = None  # Optional httpmetrics.HttpMetrics recording every request
+    requests_count = 0
+    reused_connections_count = 0  # Number of requests sent through an already opened connection
+    timeout = None
+
+    def __init__(self, max_idle_connections = None, metrics = None, timeout = None):
+        if max_idle_connections is not None:
+            assert max_idle_connections > 0
+            self.max_idle_connections = max_idle_connections
+        self.metrics = metrics
+        if timeout is not None:
+            self.timeout = timeout
+        self.idle_connections_by_key = {}
+        self.lock = threading.Lock()
+
+    def acquire_connection(self, key):
+        """Return an idle connection to the given (scheme, netloc) or a new one, and whether it is reused."""
+        while True:
+            with self.lock:
+                idle_connections = self.idle_connections_by_key.get(key)
+                connection = idle_connections.pop() if idle_connections else None
+                if connection is None:
+                    self.connections_count += 1
+                    break
+            if not is_connection_dropped(connection):
+                return connection, True
+            # The server closed the idle connection in the meantime.
+            log.debug(u'Discarding stale connection to {}'.format(key[1]))
+            connection.close()
+        scheme, netloc = key
+        connection_class = self.connection_class_by_scheme.get(scheme)
+        if connection_class is None:
+            raise urllib2.URLError(u'Unsupported URL scheme: {}'.format(scheme))
+        if self.timeout is None:
+            return connection_class(netloc), False
+        return connection_class(netloc, timeout = self.timeout), False
+
+    def close(self):
+        with self.lock:
+            idle_connections_by_key = self.idle_connections_by_key
+            self.idle_connections_by_key = {}
+        for idle_connections in idle_connections_by_key.itervalues():
+            for connection in idle_connections:
+                connection.close()
+
+    def release_connection(self, key, connection):
+        with self.lock:
+            idle_connections = self.idle_connections_by_key.setdefault(key, [])
+            if len(idle_connections) < self.max_idle_connections:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def send(self, key, method, selector, body, headers, timeout = None):
+        start_time = time.time()
+        while True:
+            connection, reused = self.acquire_connection(key)
+            if timeout is not None:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+            step = 'request'
+            try:
+                connection.request(method, selector, body, headers)
+                step = 'status'
+                response = connection.getresponse()
+                step = 'content'
+                content = response.read()
+            except (httplib.HTTPException, socket.error) as error:
+                connection.close()
+                if reused and method in idempotent_methods and not isinstance(error, socket.timeout) and (
+                        step == 'request' or step == 'status' and is_closed_before_response(error)):
+                    # The server closed the reused connection without processing the request. Retry with another
+                    # connection.
+                    log.debug(u'Retrying request on stale connection to {}'.format(key[1]))
+                    continue
+                if self.metrics is not None:
+                    self.metrics.record_url(urlparse.urljoin(u'{}://{}'.format(*key), selector),
+                        time.time() - start_time, error = True)
+                raise
+            break
+        if self.metrics is not None:
+            self.metrics.record_url(urlparse.urljoin(u'{}://{}'.format(*key), selector), time.time() - start_time,
+                bytes_count = len(content), error = not 200 <= response.status < 400)
+        with self.lock:
+            self.requests_count += 1
+            if reused:
+                self.reused_connections_count += 1
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(key, connection)
+        return response, content
+
+    def statistics(self):
+        with self.lock:
+            return dict(
+                connections_count = self.connections_count,
+                requests_count = self.requests_count,
+                reused_connections_count = self.reused_connections_count,
+                )
+
+    def statistics_to_str(self):
+        statistics = self.statistics()
+        return u'{} requests, {} connections opened, {} requests using a reused connection ({:.0%})'.format(
+            statistics['requests_count'],
+            statistics['connections_count'],
+            statistics['reused_connections_count'],
+            float(statistics['reused_connections_count']) / statistics['requests_count']
+                if statistics['requests_count'] else 0,
+            )
+
+    def urlopen(self, request, data = None, timeout = None):
+        """Send a request and return a file-like response, raising urllib2.HTTPError like urllib2.urlopen.
+
+        When given, timeout overrides the timeout of the client for this request.
+        """
+        if isinstance(request, basestring):
+            request = urllib2.Request(request)
+        if data is not None:
+            request.add_data(data)
+        url = request.get_full_url()
+        if isinstance(url, unicode):
+            # Avoid unicode request lines, that httplib fails to concatenate with non ASCII bodies.
+            url = url.encode('utf-8')
+        method = request.get_method()
+        body = request.get_data()
+        headers = dict(request.header_items())
+        if body is not None and not any(name.lower() == 'content-type' for name in headers):
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        for redirections_count in range(self.max_redirections + 1):
+            split_url = urlparse.urlsplit(url)
+            selector = urlparse.urlunsplit(('', '', split_url.path or '/', split_url.query, ''))
+            response, content = self.send((split_url.scheme, split_url.netloc), method, selector, body, headers,
+                timeout = timeout)
+            if response.status not in redirect_codes or response.getheader('location') is None:
+                break
+            url = urlparse.urljoin(url, response.getheader('location'))
+            if response.status in (302, 303) and method == 'POST':
+                # Behave like urllib2 and browsers: follow redirection with a GET.
+                method = 'GET'
+                body = None
+                headers = dict(
+                    (name, value)
+                    for name, value in headers.iteritems()
+                    if name.lower() not in ('content-length', 'content-type')
+                    )
+        else:
+            raise urllib2.HTTPError(url, response.status, u'Too many redirections', response.msg,
+                cStringIO.StringIO(content))
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, cStringIO.StringIO(content))
+        result = urllib.addinfourl(cStringIO.StringIO(content), response.msg, url, response.status)
+        result.msg = response.reason
+        return result
+
+
+def is_closed_before_response(error):
+    """Return whether an error raised while waiting for the status line means that the server closed the connection
+    before sending any byte of a response."""
+    if isinstance(error, httplib.BadStatusLine):
+        # httplib raises BadStatusLine with an invalid status line, or with a message when it received nothing.
+        return not error.line.startswith('HTTP/')
+    return isinstance(error, socket.error) and error.errno == errno.ECONNRESET
+
+
+def is_connection_dropped(connection):
+    """Return whether an idle connection has been closed by the server (or has received unexpected data)."""
+    if connection.sock is None:
+        return True
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Instrumentation of the HTTP requests sent by harvesters, to know where a harvest spends its time
+
+Every request (to source sites through urllib2 & to target CKAN through the pooled HTTP client) is timed and tagged
+by host and endpoint (the CKAN action, for CKAN API calls). At the end of a run, a report of the number of requests,
+the bytes received, the latency percentiles & the number of errors is written as JSON and as a Prometheus textfile.
+"""
+
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib2
+import urlparse
+
+
+action_path_re = re.compile(ur'/api/(?:\d+/)?action/(?P<action>[^/]+)$')
+id_segment_re = re.compile(ur'^(\d+|[\da-f-]{16,})$', re.IGNORECASE)
+log = logging.getLogger(__name__)
+max_endpoint_segments = 4
+percentiles = (50, 95, 99)
+
+
+class HttpMetrics(object):
+    """Statistics of HTTP requests, per (host, endpoint). It can be shared between threads."""
+    lock = None
+    statistics_by_key = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statistics_by_key = {}
+
+    def add_bytes(self, host, endpoint, bytes_count):
+        with self.lock:
+            self.get_statistics(host, endpoint)['bytes'] += bytes_count
+
+    def get_statistics(self, host, endpoint):
+        statistics = self.statistics_by_key.get((host, endpoint))
+        if statistics is None:
+            statistics = self.statistics_by_key[(host, endpoint)] = dict(
+                bytes = 0,
+                count = 0,
+                errors = 0,
+                latencies = [],
+                )
+        return statistics
+
+    def record(self, host, endpoint, latency, bytes_count = 0, error = False):
+        with self.lock:
+            statistics = self.get_statistics(host, endpoint)
+            statistics['bytes'] += bytes_count
+            statistics['count'] += 1
+            if error:
+                statistics['errors'] += 1
+            statistics['latencies'].append(latency)
+
+    def record_url(self, url, latency, bytes_count = 0, error = False):
+        host, endpoint = url_to_host_and_endpoint(url)
+        self.record(host, endpoint, latency, bytes_count = bytes_count, error = error)
+
+    def report(self):
+        """Return the statistics of every (host, endpoint), sorted by host & endpoint."""
+        with self.lock:
+            items = sorted(
+                (key, dict(statistics, latencies = sorted(statistics['latencies'])))
+                for key, statistics in self.statistics_by_key.iteritems()
+                )
+        report = []
+        for (host, endpoint), statistics in items:
+            latencies = statistics['latencies']
+            entry = dict(
+                bytes = statistics['bytes'],
+                count = statistics['count'],
+                endpoint = endpoint,
+                errors = statistics['errors'],
+                host = host,
+                latency_total = sum(latencies),
+                )
+            for percentile in percentiles:
+                entry['latency_p{}'.format(percentile)] = get_percentile(latencies, percentile)
+            report.append(entry)
+        return report
+
+    def report_to_str(self):
+        return u'\n'.join(
+            u'  {host} {endpoint}: {count} requests, {errors} errors, {bytes} bytes, {latency_total:.1f}s, '
+            u'p50 {latency_p50:.3f}s, p95 {latency_p95:.3f}s, p99 {latency_p99:.3f}s'.format(**entry)
+            for entry in sorted(self.report(), key = lambda entry: entry['latency_total'], reverse = True)
+            )
+
+    def write_report(self, dir_path, name):
+        """Write the report in dir_path, as <name>.json & as <name>.prom (for Prometheus textfile collector)."""
+        report = self.report()
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        write_atomically(os.path.join(dir_path, u'{}.json'.format(name)),
+            json.dumps(report, indent = 2, sort_keys = True))
+        lines = []
+        for metric_name, metric_type, help in (
+                ('harvester_http_requests_total', 'counter', 'Number of HTTP requests'),
+                ('harvester_http_errors_total', 'counter', 'Number of HTTP requests failed or answered with an error'),
+                ('harvester_http_response_bytes_total', 'counter', 'Number of bytes received in HTTP responses'),
+                ('harvester_http_request_duration_seconds', 'summary', 'Latency of HTTP requests'),
+                ):
+            lines.append('# HELP {} {}'.format(metric_name, help))
+            lines.append('# TYPE {} {}'.format(metric_name, metric_type))
+            for entry in report:
+                labels = u'endpoint="{}",harvester="{}",host="{}"'.format(*(
+                    escape_label_value(value)
+                    for value in (entry['endpoint'], name, entry['host'])
+                    ))
+                if metric_type == 'summary':
+                    for percentile in percentiles:
+                        lines.append(u'{}{{{},quantile="{}"}} {}'.format(metric_name, labels, percentile / 100.0,
+                            entry['latency_p{}'.format(percentile)]))
+                    lines.append(u'{}_sum{{{}}} {}'.format(metric_name, labels, entry['latency_total']))
+                    lines.append(u'{}_count{{{}}} {}'.format(metric_name, labels, entry['count']))
+                else:
+                    lines.append(u'{}{{{}}} {}'.format(metric_name, labels, dict(
+                        harvester_http_errors_total = entry['errors'],
+                        harvester_http_requests_total = entry['count'],
+                        harvester_http_response_bytes_total = entry['bytes'],
+                        )[metric_name]))
+        write_atomically(os.path.join(dir_path, u'{}.prom'.format(name)), u'\n'.join(lines + [u'']).encode('utf-8'))
+
+
+class MetricsHandler(urllib2.BaseHandler):
+    """urllib2 handler recording the HTTP requests (including each redirection) in metrics"""
+    handler_order = 100  # Process responses before HTTPErrorProcessor converts them to errors.
+    metrics = None
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def http_request(self, request):
+        request.metrics_start_time = time.time()
+        return request
+
+    def http_response(self, request, response):
+        start_time = getattr(request, 'metrics_start_time', None)
+        if start_time is None:
+            return response
+        latency = time.time() - start_time
+        host, endpoint = url_to_host_and_endpoint(request.get_full_url())
+        self.metrics.record(host, endpoint, latency, error = not 200 <= response.code < 400)
+        read = response.read
+
+        def read_and_count(*args, **kwargs):
+            data = read(*args, **kwargs)
+            self.metrics.add_bytes(host, endpoint, len(data))
+            return data
+
+        response.read = read_and_count
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+def escape_label_value(value):
+    return value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+def get_percentile(sorted_values, percentile):
+    """Return the given percentile (nearest-rank method) of a sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, int(round(percentile / 100.0 * len(sorted_values))) - 1)]
+
+
+def install_opener(name, metrics_dir = None):
+    """Time every request sent through urllib2 and report the statistics at exit (in metrics directory, if any)."""
+    metrics = HttpMetrics()
+    urllib2.install_opener(urllib2.build_opener(MetricsHandler(metrics)))
+
+    def report():
+        log.info(u'HTTP requests (by decreasing total time):\n{}'.format(metrics.report_to_str()))
+        if metrics_dir is not None:
+            metrics.write_report(metrics_dir, name)
+
+    atexit.register(report)
+    return metrics
+
+
+def url_to_host_and_endpoint(url):
+    """Return the host of an URL and its endpoint: CKAN action or path without its identifiers & query."""
+    if isinstance(url, str):
+        url = url.decode('utf-8')
+    split_url = urlparse.urlsplit(url)
+    path = split_url.path or u'/'
+    match = action_path_re.search(path)
+    if match is not None:
+        return split_url.netloc, match.group('action')
+    segments = [
+        u':id' if id_segment_re.match(segment) is not None else segment
+        for segment in path.split(u'/')[1:max_endpoint_segments + 1]
+        ]
+    return split_url.netloc, u'/' + u'/'.join(segments)
+
+
+def write_atomically(file_path, data):
+    """Write a file through a temporary one, so that a collector never reads a half-written report."""
+    temporary_file_path = file_path + u'.tmp'
+    with open(temporary_file_path, 'w') as report_file:
+        report_file.write(data)
+    os.rename(temporary_file_path, file_path)
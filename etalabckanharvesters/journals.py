@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Append-only journal of the operations completed by a harvester while updating target
+
+Every completed upsert, update of related links & deletion is appended (as a JSON line) to the journal of the run. When
+a run is interrupted, the next run can resume it: the operations found in its journal (with the same fingerprint) are
+not done again. The journal of a run is removed once the run is completed.
+"""
+
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class CheckpointJournal(object):
+    """Journal of a run of a harvester. It can be shared between threads."""
+    entry_by_key = None  # Entries of the journal, by (operation, name)
+    file = None
+    file_path = None
+    lock = None
+    run_id = None
+
+    def __init__(self, journals_dir, run_id = None, resume = False):
+        if not os.path.exists(journals_dir):
+            os.makedirs(journals_dir)
+        if resume and run_id is None:
+            # Resume the latest interrupted run (the journals of completed runs are removed), ignoring the runs
+            # interrupted before any operation was done.
+            runs_id = [
+                file_name[:-len('.jsonl')]
+                for modification_time, file_name in sorted(
+                    (os.path.getmtime(os.path.join(journals_dir, file_name)), file_name)
+                    for file_name in os.listdir(journals_dir)
+                    if file_name.endswith('.jsonl') and os.path.getsize(os.path.join(journals_dir, file_name)) > 0
+                    )
+                ]
+            if runs_id:
+                run_id = runs_id[-1]
+            else:
+                log.warning(u'No interrupted run to resume in {}'.format(journals_dir))
+        if run_id is None:
+            run_id = time.strftime('%Y%m%dT%H%M%S')
+        self.run_id = run_id
+        self.file_path = os.path.join(journals_dir, u'{}.jsonl'.format(run_id))
+        self.entry_by_key = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.file_path):
+            if not resume:
+                raise ValueError(u'Journal of run {} already exists. Resume it or use another run ID: {}'.format(
+                    run_id, self.file_path))
+            with open(self.file_path) as journal_file:
+                content = journal_file.read()
+            for line in content.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line has been truncated by the interruption of the run.
+                    continue
+                self.entry_by_key[(entry['operation'], entry['name'])] = entry
+            log.info(u'Resuming run {}: {} operations already done'.format(run_id, len(self.entry_by_key)))
+        else:
+            content = ''
+        self.file = open(self.file_path, 'a')
+        if content and not content.endswith('\n'):
+            self.file.write('\n')
+
+    def finish(self):
+        """Close the journal of a completed run and remove it, since there is nothing left to resume."""
+        with self.lock:
+            self.file.close()
+            os.remove(self.file_path)
+
+    def get(self, operation, name, fingerprint = None):
+        """Return the entry of an operation done (on the same data) by the run, or None."""
+        entry = self.entry_by_key.get((operation, name))
+        if entry is None or entry.get('fingerprint') != fingerprint:
+            return None
+        return entry
+
+    def record(self, operation, name, fingerprint = None, result = None):
+        entry = dict(
+            fingerprint = fingerprint,
+            name = name,
+            operation = operation,
+            result = result,
+            )
+        line = json.dumps(entry, sort_keys = True)
+        with self.lock:
+            self.entry_by_key[(operation, name)] = entry
+            self.file.write(line + '\n')
+            self.file.flush()
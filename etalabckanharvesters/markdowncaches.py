@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Persistent, content-addressed cache of HTML to Markdown conversions
+
+Each conversion is stored in a file named by the hash of the converter version & of the HTML, so that a new version of
+pandoc doesn't reuse the conversions of the previous one. When the cache is larger than its maximum size, the least
+recently used conversions are removed.
+"""
+
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class MarkdownCache(object):
+    """Cache of HTML to Markdown conversions, stored in a directory. It can be shared between threads."""
+    dir_path = None
+    entry_by_key = None  # (Access time, size) of each cached conversion
+    hits_count = 0
+    lock = None
+    max_size = 100 * 1024 * 1024  # Max total size (in bytes) of cached conversions
+    misses_count = 0
+    size = 0  # Total size (in bytes) of cached conversions
+    version = None  # Version of converter (part of the key of each conversion)
+
+    def __init__(self, dir_path, version, max_size = None):
+        self.dir_path = dir_path
+        self.version = version
+        if max_size is not None:
+            assert max_size > 0
+            self.max_size = max_size
+        self.entry_by_key = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        for parent_dir_path, dirs_name, files_name in os.walk(dir_path):
+            for file_name in files_name:
+                if not file_name.endswith('.md'):
+                    continue
+                file_stat = os.stat(os.path.join(parent_dir_path, file_name))
+                self.entry_by_key[file_name[:-len('.md')]] = (file_stat.st_atime, file_stat.st_size)
+                self.size += file_stat.st_size
+
+    def evict(self):
+        """Remove the least recently used conversions until the cache is 10% below its maximum size."""
+        with self.lock:
+            if self.size <= self.max_size:
+                return
+            evicted_count = 0
+            for access_time, key in sorted(
+                    (access_time, key)
+                    for key, (access_time, size) in self.entry_by_key.iteritems()
+                    ):
+                if self.size <= self.max_size * 0.9:
+                    break
+                access_time, size = self.entry_by_key.pop(key)
+                self.size -= size
+                try:
+                    os.remove(self.get_file_path(key))
+                except OSError:
+                    pass
+                evicted_count += 1
+        log.info(u'Evicted {} conversions from Markdown cache'.format(evicted_count))
+
+    def get(self, html):
+        """Return the cached Markdown of an HTML fragment, or None."""
+        key = self.get_key(html)
+        with self.lock:
+            if key not in self.entry_by_key:
+                self.misses_count += 1
+                return None
+        file_path = self.get_file_path(key)
+        try:
+            with open(file_path) as markdown_file:
+                markdown = markdown_file.read().decode('utf-8')
+        except IOError:
+            with self.lock:
+                self.misses_count += 1
+                access_time, size = self.entry_by_key.pop(key, (None, 0))
+                self.size -= size
+            return None
+        now = time.time()
+        with self.lock:
+            self.hits_count += 1
+            if key in self.entry_by_key:
+                self.entry_by_key[key] = (now, self.entry_by_key[key][1])
+        try:
+            os.utime(file_path, (now, os.stat(file_path).st_mtime))
+        except OSError:
+            pass
+        return markdown
+
+    def get_file_path(self, key):
+        return os.path.join(self.dir_path, key[:2], key + '.md')
+
+    def get_key(self, html):
+        return hashlib.sha1(u'{}\0{}'.format(self.version, html).encode('utf-8')).hexdigest()
+
+    def put(self, html, markdown):
+        key = self.get_key(html)
+        file_path = self.get_file_path(key)
+        data = markdown.encode('utf-8')
+        if not os.path.exists(os.path.dirname(file_path)):
+            try:
+                os.makedirs(os.path.dirname(file_path))
+            except OSError:
+                # Directory has been created by another thread.
+                pass
+        temporary_file_path = '{}.{}.tmp'.format(file_path, threading.current_thread().ident)
+        with open(temporary_file_path, 'w') as markdown_file:
+            markdown_file.write(data)
+        os.rename(temporary_file_path, file_path)
+        with self.lock:
+            access_time, size = self.entry_by_key.get(key, (None, 0))
+            self.entry_by_key[key] = (time.time(), len(data))
+            self.size += len(data) - size
+            over_size = self.size > self.max_size
+        if over_size:
+            self.evict()
+
+    def statistics_to_str(self):
+        with self.lock:
+            requests_count = self.hits_count + self.misses_count
+            return u'{} hits, {} misses ({:.0%} hit ratio), {} conversions, {} bytes'.format(self.hits_count,
+                self.misses_count, float(self.hits_count) / requests_count if requests_count else 0,
+                len(self.entry_by_key), self.size)
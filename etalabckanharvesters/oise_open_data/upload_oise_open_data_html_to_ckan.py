@@ -198,6 +198,7 @@ def main():
     parser.add_argument('download_dir', help = 'directory where are stored downloaded HTML pages')
     parser.add_argument('-d', '--dry-run', action = 'store_true',
         help = "simulate harvesting, don't update CKAN repository")
+    helpers.add_target_arguments(parser)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
@@ -239,7 +240,7 @@ def main():
             'User-Agent': conf['user_agent'],
             },
         target_site_url = conf['ckan.site_url'],
-        )
+        **helpers.target_options(args))
 
     # Retrieve paths of HTML pages to convert.
     data_dir = os.path.join(args.download_dir, 'data')
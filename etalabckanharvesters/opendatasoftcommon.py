@@ -30,17 +30,28 @@ http://www.opendatasoft.com/
 """
 
 
+import hashlib
+import HTMLParser
+import json
 import logging
+import os
+import re
+import sqlite3
 import subprocess
+import threading
 import urllib2
 import urlparse
+import uuid
 
 from biryani1 import baseconv, custom_conv, datetimeconv, jsonconv, states
 
-from . import helpers
+from . import helpers, markdowncaches
 
 
+batch_check_size = 2  # Number of fragments of each batch also converted alone, to check the Markdown of the batch
+batching_enabled = True  # Cleared when a batch of pandoc gives a Markdown different from a conversion alone
 conv = custom_conv(baseconv, datetimeconv, jsonconv, states)
+conversion_version = 1  # Version of build_json_to_dataset, to increment when it converts datasets differently
 format_by_mimetype = {
     u'application/msword': u'DOC',
     u'application/octet-stream': None,
@@ -58,7 +69,180 @@ frequency_by_accrualperiodicity = {
     u'Toutes les semaines': u"hebdomadaire",
     u'Variable': u"ponctuelle",
     }
+json_to_dataset_by_config = {}  # Cache of the converters built by make_json_to_dataset, by hashable configuration
 log = logging.getLogger(__name__)
+markdown_by_html = {}  # Cache of html_to_markdown, filled in batches by prepare_html_to_markdown
+markdown_cache = None  # Optional persistent cache of html_to_markdown, opened by open_markdown_cache
+pandoc_command = ['pandoc', '-f', 'html', '-t', 'markdown']
+pandoc_version = None  # Cache of get_pandoc_version
+unbatchable_tags = set([
+    # Tags whose conversion may depend on the rest of the document or may swallow the batch separators.
+    'blockquote', 'code', 'div', 'dl', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'iframe', 'object', 'pre', 'script',
+    'style', 'table', 'textarea',
+    ])
+void_tags = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+    'track', 'wbr'])
+
+
+class BatchabilityChecker(HTMLParser.HTMLParser):
+    """Parser checking that an HTML fragment converted in a batch gives the same Markdown as when converted alone
+
+    The fragment must only contain balanced tags, without comments, declarations & unbatchable tags.
+    """
+    batchable = True
+    open_tags = None
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.open_tags = []
+
+    def handle_comment(self, data):
+        self.batchable = False
+
+    def handle_decl(self, decl):
+        self.batchable = False
+
+    def handle_endtag(self, tag):
+        if not self.open_tags or self.open_tags.pop() != tag:
+            self.batchable = False
+
+    def handle_pi(self, data):
+        self.batchable = False
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in unbatchable_tags:
+            self.batchable = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in unbatchable_tags:
+            self.batchable = False
+        elif tag not in void_tags:
+            self.open_tags.append(tag)
+
+    def unknown_decl(self, data):
+        self.batchable = False
+
+
+class DatasetsIndex(object):
+    """Index of the datasets of an OpenDataSoft portal converted by the previous run, by datasetid
+
+    A dataset whose metas.modified didn't change since previous run is not converted again (avoiding pandoc): the
+    dataset converted by previous run is reused. The index is kept in a SQLite database of state directory (when there
+    is one), where each dataset is looked up when needed, so that the catalog is not kept in memory. It is emptied
+    when the converter changes (configuration given to make_json_to_dataset, conversion_version, pandoc version, etc).
+
+    The changes of a run are committed by save(): the index of an interrupted run stays the one of the previous run.
+    """
+    connection = None
+    converted_count = 0  # Number of datasets converted by this run
+    converter_fingerprint = None  # Fingerprint of the converter wrapped by this run
+    lock = None
+    reused_count = 0  # Number of datasets reused from previous run
+    run_id = None  # Random ID marking the datasets converted or reused by this run
+
+    def __init__(self, state_dir, source_site_url):
+        self.lock = threading.Lock()
+        self.run_id = uuid.uuid4().hex
+        if state_dir is None:
+            return
+        dir_path = os.path.join(state_dir, 'opendatasoft-datasets')
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self.connection = sqlite3.connect(
+            os.path.join(dir_path, u'{}.sqlite'.format(urlparse.urlsplit(source_site_url).netloc)),
+            check_same_thread = False)
+        with self.connection:
+            self.connection.execute('''\
+                CREATE TABLE IF NOT EXISTS converters (
+                    fingerprint TEXT NOT NULL
+                    )
+                ''')
+            self.connection.execute('''\
+                CREATE TABLE IF NOT EXISTS datasets (
+                    datasetid TEXT PRIMARY KEY,
+                    modified TEXT NOT NULL,
+                    dataset TEXT NOT NULL,
+                    run_id TEXT NOT NULL
+                    )
+                ''')
+
+    def get_entry(self, datasetid):
+        """Return the modification time & the JSON of the converted dataset of a dataset of the index, or (None, None).
+        """
+        if self.connection is None or datasetid is None:
+            return None, None
+        with self.lock:
+            row = self.connection.execute('SELECT modified, dataset FROM datasets WHERE datasetid = ?',
+                (datasetid,)).fetchone()
+        return row if row is not None else (None, None)
+
+    def is_unchanged(self, value):
+        """Return whether a (JSON) dataset is unchanged since previous run, and won't be converted again."""
+        modified = (value.get(u'metas') or {}).get(u'modified')
+        return modified is not None and self.get_entry(value.get(u'datasetid'))[0] == modified
+
+    def save(self):
+        """Commit the datasets of this run in the index (forgetting the datasets that disappeared)."""
+        log.info(u'{} datasets unchanged since previous run, {} converted'.format(self.reused_count,
+            self.converted_count))
+        if self.connection is None:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM datasets WHERE run_id != ?', (self.run_id,))
+
+    def wrap_json_to_dataset(self, json_to_dataset):
+        """Return a converter like json_to_dataset, but reusing the datasets unchanged since previous run.
+
+        json_to_dataset must have been made by make_json_to_dataset. Call this method before is_unchanged.
+        """
+        converter_fingerprint = hashlib.sha1(repr((
+            conversion_version,
+            json_to_dataset.config,
+            to_hashable(format_by_mimetype),
+            to_hashable(frequency_by_accrualperiodicity),
+            to_hashable(helpers.groups_title),
+            get_pandoc_version() if self.connection is not None else None,
+            ))).hexdigest()
+        assert self.converter_fingerprint in (None, converter_fingerprint), \
+            u'A datasets index can only be used with a single converter'
+        self.converter_fingerprint = converter_fingerprint
+        if self.connection is not None:
+            with self.lock:
+                previous_converter_fingerprint = (self.connection.execute(
+                    'SELECT fingerprint FROM converters').fetchone() or (None,))[0]
+                if converter_fingerprint != previous_converter_fingerprint:
+                    if previous_converter_fingerprint is not None:
+                        log.info(u'Converter of datasets has changed since previous run: converting every dataset'
+                            u' again')
+                    # Like every change of the run, this is committed by save().
+                    self.connection.execute('DELETE FROM converters')
+                    self.connection.execute('DELETE FROM datasets')
+                    self.connection.execute('INSERT INTO converters (fingerprint) VALUES (?)',
+                        (converter_fingerprint,))
+
+        def json_to_indexed_dataset(value, state = None):
+            datasetid = value.get(u'datasetid') if isinstance(value, dict) else None
+            modified = (value.get(u'metas') or {}).get(u'modified') if datasetid is not None else None
+            if modified is not None:
+                entry_modified, dataset_json = self.get_entry(datasetid)
+                if entry_modified == modified:
+                    with self.lock:
+                        self.connection.execute('UPDATE datasets SET run_id = ? WHERE datasetid = ?',
+                            (self.run_id, datasetid))
+                        self.reused_count += 1
+                    return json.loads(dataset_json), None
+            dataset, errors = json_to_dataset(value, state = state)
+            if errors is None:
+                with self.lock:
+                    self.converted_count += 1
+                    if self.connection is not None and modified is not None:
+                        self.connection.execute(
+                            '''INSERT OR REPLACE INTO datasets (datasetid, modified, dataset, run_id)
+                            VALUES (?, ?, ?, ?)''',
+                            (datasetid, modified, json.dumps(dataset), self.run_id))
+            return dataset, errors
+
+        return json_to_indexed_dataset
 
 
 def add_dataset(dataset, dry_run, granularity_translations, harvester, license_id_by_license, publishers_to_ignore,
@@ -172,263 +356,257 @@ def add_dataset(dataset, dry_run, granularity_translations, harvester, license_i
             related = related)
 
 
-def html_to_markdown(value, state = None):
-    if value is None:
-        return value, None
-    process = subprocess.Popen(['pandoc', '-f', 'html', '-t', 'markdown'], stdin = subprocess.PIPE,
-        stdout = subprocess.PIPE)
-    stdout, stderr = process.communicate(value.encode('utf-8'))
-    return stdout.decode('utf-8'), None
-
-
-def make_json_to_dataset(creators, domain, granularity_translations, group_title_translations, license_id_by_license,
+def build_json_to_dataset(creators, domain, granularity_translations, group_title_translations, license_id_by_license,
         temporals, default_publisher = None):
-    def json_to_dataset(value, state = None):
-        dataset, errors = conv.pipe(
-            conv.test_isinstance(dict),
-            conv.struct(
-                dict(
-                    attachments = conv.pipe(
-                        conv.test_isinstance(list),
-                        conv.uniform_sequence(
-                            conv.pipe(
-                                conv.test_isinstance(dict),
-                                conv.struct(
-                                    dict(
-                                        id = conv.pipe(
-                                            conv.test_isinstance(basestring),
-                                            conv.empty_to_none,
-                                            conv.not_none,
-                                            ),
-                                        mimetype = conv.pipe(
-                                            conv.test_isinstance(basestring),
-                                            conv.test_in(format_by_mimetype),
-                                            conv.not_none,
-                                            ),
-                                        title = conv.pipe(
-                                            conv.test_isinstance(basestring),
-                                            conv.cleanup_line,
-                                            conv.not_none,
-                                            ),
-                                        url = conv.pipe(
-                                            conv.test_isinstance(basestring),
-                                            conv.make_input_to_url(full = True, schemes = ('odsfile',)),
-#                                            conv.test(lambda url: url.startswith(u'odsfile://{}/'.format(domain))),
-                                            conv.not_none,
-                                            ),
+    """Build a converter from the JSON of an OpenDataSoft dataset to a dataset. Use make_json_to_dataset instead."""
+    validate_dataset = conv.pipe(
+        conv.test_isinstance(dict),
+        conv.struct(
+            dict(
+                attachments = conv.pipe(
+                    conv.test_isinstance(list),
+                    conv.uniform_sequence(
+                        conv.pipe(
+                            conv.test_isinstance(dict),
+                            conv.struct(
+                                dict(
+                                    id = conv.pipe(
+                                        conv.test_isinstance(basestring),
+                                        conv.empty_to_none,
+                                        conv.not_none,
+                                        ),
+                                    mimetype = conv.pipe(
+                                        conv.test_isinstance(basestring),
+                                        conv.test_in(format_by_mimetype),
+                                        conv.not_none,
+                                        ),
+                                    title = conv.pipe(
+                                        conv.test_isinstance(basestring),
+                                        conv.cleanup_line,
+                                        conv.not_none,
+                                        ),
+                                    url = conv.pipe(
+                                        conv.test_isinstance(basestring),
+                                        conv.make_input_to_url(full = True, schemes = ('odsfile',)),
+#                                        conv.test(lambda url: url.startswith(u'odsfile://{}/'.format(domain))),
+                                        conv.not_none,
                                         ),
                                     ),
-                                conv.not_none,
                                 ),
+                            conv.not_none,
                             ),
-                        conv.not_none,
-                        ),
-                    datasetid = conv.pipe(
-                        conv.test_isinstance(basestring),
-                        conv.empty_to_none,
-                        conv.not_none,
                         ),
-                    features = conv.pipe(
-                        conv.test_isinstance(list),
-                        conv.uniform_sequence(
-                            conv.pipe(
-                                conv.test_isinstance(basestring),
-                                conv.test_in([
-                                    u'analyze',
-                                    u'geo',
-                                    u'image',
-                                    u'timeserie',
-                                    ]),
-                                conv.not_none,
-                                ),
+                    conv.not_none,
+                    ),
+                datasetid = conv.pipe(
+                    conv.test_isinstance(basestring),
+                    conv.empty_to_none,
+                    conv.not_none,
+                    ),
+                features = conv.pipe(
+                    conv.test_isinstance(list),
+                    conv.uniform_sequence(
+                        conv.pipe(
+                            conv.test_isinstance(basestring),
+                            conv.test_in([
+                                u'analyze',
+                                u'geo',
+                                u'image',
+                                u'timeserie',
+                                ]),
+                            conv.not_none,
                             ),
-                        conv.not_none,
                         ),
-                    fields = conv.pipe(
-                        conv.test_isinstance(list),
-                        conv.uniform_sequence(
-                            conv.pipe(
-                                conv.test_isinstance(dict),
-                                # TODO
-                                conv.not_none,
-                                ),
+                    conv.not_none,
+                    ),
+                fields = conv.pipe(
+                    conv.test_isinstance(list),
+                    conv.uniform_sequence(
+                        conv.pipe(
+                            conv.test_isinstance(dict),
+                            # TODO
+                            conv.not_none,
                             ),
-                        conv.not_none,
                         ),
-                    has_records = conv.pipe(
-                        conv.test_isinstance(bool),
-                        conv.not_none,
-                        ),
-#                    interop_metas = conv.pipe(
-#                        conv.test_isinstance(dict),
-#                        conv.struct(
-#                            dict(
-#                                dcat = conv.pipe(
-#                                    conv.test_isinstance(dict),
-#                                    conv.struct(
-#                                        dict(
-#                                            created = conv.pipe(
-#                                                conv.test_isinstance(basestring),
-#                                                conv.iso8601_input_to_date,
-#                                                conv.date_to_iso8601_str,
-#                                                ),
-#                                            granularity = conv.pipe(
-#                                                conv.test_isinstance(basestring),
-#                                                conv.cleanup_line,
-#                                                conv.test_in(granularity_translations),
-#                                                ),
-#                                            issued = conv.pipe(
-#                                                conv.test_isinstance(basestring),
-#                                                conv.iso8601_input_to_date,
-#                                                conv.date_to_iso8601_str,
-#                                                ),
-#                                            spatial = conv.pipe(
-#                                                conv.test_isinstance(basestring),
-#                                                conv.make_input_to_url(full = True),
-#                                                ),
+                    conv.not_none,
+                    ),
+                has_records = conv.pipe(
+                    conv.test_isinstance(bool),
+                    conv.not_none,
+                    ),
+#                interop_metas = conv.pipe(
+#                    conv.test_isinstance(dict),
+#                    conv.struct(
+#                        dict(
+#                            dcat = conv.pipe(
+#                                conv.test_isinstance(dict),
+#                                conv.struct(
+#                                    dict(
+#                                        created = conv.pipe(
+#                                            conv.test_isinstance(basestring),
+#                                            conv.iso8601_input_to_date,
+#                                            conv.date_to_iso8601_str,
+#                                            ),
+#                                        granularity = conv.pipe(
+#                                            conv.test_isinstance(basestring),
+#                                            conv.cleanup_line,
+#                                            conv.test_in(granularity_translations),
+#                                            ),
+#                                        issued = conv.pipe(
+#                                            conv.test_isinstance(basestring),
+#                                            conv.iso8601_input_to_date,
+#                                            conv.date_to_iso8601_str,
+#                                            ),
+#                                        spatial = conv.pipe(
+#                                            conv.test_isinstance(basestring),
+#                                            conv.make_input_to_url(full = True),
 #                                            ),
 #                                        ),
-#                                    conv.not_none,
 #                                    ),
+#                                conv.not_none,
 #                                ),
 #                            ),
-#                        conv.not_none,
 #                        ),
-                    metas = conv.pipe(
-                        conv.test_isinstance(dict),
-                        conv.struct(
-                            dict(
-                                accrualperiodicity = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.test_in(frequency_by_accrualperiodicity),
-                                    ),
-                                created = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.iso8601_input_to_date,
-                                    conv.date_to_iso8601_str,
-                                    ),
-                                creator = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.cleanup_line,
-                                    conv.test_in(creators),
-                                    ),
-                                description = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    html_to_markdown,
-                                    conv.cleanup_text,
-                                    ),
-                                domain = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.test_equals(domain),
-                                    conv.not_none,
-                                    ),
-                                granularity = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.cleanup_line,
-                                    conv.test_in(granularity_translations),
-                                    ),
-                                issued = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.iso8601_input_to_date,
-                                    conv.date_to_iso8601_str,
-                                    ),
-                                keyword = conv.pipe(
-                                    conv.make_item_to_singleton(),
-                                    conv.uniform_sequence(
-                                        conv.pipe(
-                                            conv.test_isinstance(basestring),
-                                            conv.input_to_slug,
-                                            ),
-                                        drop_none_items = True,
+#                    conv.not_none,
+#                    ),
+                metas = conv.pipe(
+                    conv.test_isinstance(dict),
+                    conv.struct(
+                        dict(
+                            accrualperiodicity = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.test_in(frequency_by_accrualperiodicity),
+                                ),
+                            created = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.iso8601_input_to_date,
+                                conv.date_to_iso8601_str,
+                                ),
+                            creator = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.cleanup_line,
+                                conv.test_in(creators),
+                                ),
+                            description = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                html_to_markdown,
+                                conv.cleanup_text,
+                                ),
+                            domain = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.test_equals(domain),
+                                conv.not_none,
+                                ),
+                            granularity = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.cleanup_line,
+                                conv.test_in(granularity_translations),
+                                ),
+                            issued = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.iso8601_input_to_date,
+                                conv.date_to_iso8601_str,
+                                ),
+                            keyword = conv.pipe(
+                                conv.make_item_to_singleton(),
+                                conv.uniform_sequence(
+                                    conv.pipe(
+                                        conv.test_isinstance(basestring),
+                                        conv.input_to_slug,
                                         ),
-                                    conv.empty_to_none,
+                                    drop_none_items = True,
                                     ),
-                                language = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.input_to_slug,
-                                    conv.translate({
-                                        u'7-jours-a-partir-de-la-date-de-publication': None,
-                                        u'francais': u'fr',
-                                        }),
-                                    conv.test_in([u'en', u'fr', u'nl']),
-                                    ),
-                                license = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.test_in(license_id_by_license),
-                                    ),
-                                modified = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.iso8601_input_to_datetime,
-                                    conv.datetime_to_iso8601_str,
-                                    conv.not_none,
-                                    ),
-                                publisher = conv.pipe(
-                                    conv.test_isinstance(basestring),
-#                                    conv.test_in(author_by_publisher),
-                                    conv.not_none if default_publisher is None else conv.default(default_publisher),
-                                    ),
-                                records_count = conv.test_isinstance(int),
-                                references = conv.pipe(
-                                    conv.test_isinstance(basestring),
-#                                    conv.make_input_to_url(full = True),
-                                    conv.cleanup_line,
-                                    ),
-                                spatial = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.make_input_to_url(full = True),
-                                    ),
-                                temporal = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.cleanup_line,
-                                    conv.translate({
-                                        u'N/A': None,
-                                        }),
-                                    conv.test_in(temporals),
-                                    ),
-                                temporal_coverage_from = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.iso8601_input_to_date,
-                                    conv.date_to_iso8601_str,
-                                    ),
-                                temporal_coverage_to = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.iso8601_input_to_date,
-                                    conv.date_to_iso8601_str,
-                                    ),
-                                theme = conv.pipe(
-                                    conv.make_item_to_singleton(),
-                                    conv.uniform_sequence(
-                                        conv.pipe(
-                                            conv.test_isinstance(basestring),
-                                            conv.cleanup_line,
-                                            conv.translate(group_title_translations),
-                                            conv.test_in(helpers.groups_title),
-                                            ),
-                                        drop_none_items = True,
+                                conv.empty_to_none,
+                                ),
+                            language = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.input_to_slug,
+                                conv.translate({
+                                    u'7-jours-a-partir-de-la-date-de-publication': None,
+                                    u'francais': u'fr',
+                                    }),
+                                conv.test_in([u'en', u'fr', u'nl']),
+                                ),
+                            license = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.test_in(license_id_by_license),
+                                ),
+                            modified = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.iso8601_input_to_datetime,
+                                conv.datetime_to_iso8601_str,
+                                conv.not_none,
+                                ),
+                            publisher = conv.pipe(
+                                conv.test_isinstance(basestring),
+#                                conv.test_in(author_by_publisher),
+                                conv.not_none if default_publisher is None else conv.default(default_publisher),
+                                ),
+                            records_count = conv.test_isinstance(int),
+                            references = conv.pipe(
+                                conv.test_isinstance(basestring),
+#                                conv.make_input_to_url(full = True),
+                                conv.cleanup_line,
+                                ),
+                            spatial = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.make_input_to_url(full = True),
+                                ),
+                            temporal = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.cleanup_line,
+                                conv.translate({
+                                    u'N/A': None,
+                                    }),
+                                conv.test_in(temporals),
+                                ),
+                            temporal_coverage_from = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.iso8601_input_to_date,
+                                conv.date_to_iso8601_str,
+                                ),
+                            temporal_coverage_to = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.iso8601_input_to_date,
+                                conv.date_to_iso8601_str,
+                                ),
+                            theme = conv.pipe(
+                                conv.make_item_to_singleton(),
+                                conv.uniform_sequence(
+                                    conv.pipe(
+                                        conv.test_isinstance(basestring),
+                                        conv.cleanup_line,
+                                        conv.translate(group_title_translations),
+                                        conv.test_in(helpers.groups_title),
                                         ),
-                                    conv.empty_to_none,
-                                    ),
-                                title = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.cleanup_line,
-                                    conv.not_none,
-                                    ),
-                                visibility = conv.pipe(
-                                    conv.test_isinstance(basestring),
-                                    conv.test_in([u'domain', u'public', u'restricted']),
-                                    conv.not_none,
+                                    drop_none_items = True,
                                     ),
+                                conv.empty_to_none,
+                                ),
+                            title = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.cleanup_line,
+                                conv.not_none,
+                                ),
+                            visibility = conv.pipe(
+                                conv.test_isinstance(basestring),
+                                conv.test_in([u'domain', u'public', u'restricted']),
+                                conv.not_none,
                                 ),
                             ),
-                        conv.not_none,
-                        ),
-                    shape = conv.pipe(
-                        conv.test_isinstance(dict),
-                        # TODO
                         ),
+                    conv.not_none,
+                    ),
+                shape = conv.pipe(
+                    conv.test_isinstance(dict),
+                    # TODO
                     ),
                 ),
-            )(value, state = state or conv.default_state)
+            ),
+        )
+
+    def json_to_dataset(value, state = None):
+        dataset, errors = validate_dataset(value, state = state or conv.default_state)
         if (errors is None or errors.get('metas', {}).get('visibility') is None) \
                 and dataset['metas']['visibility'] == u'restricted':
             # Skip restricted dataset, even when it contains errors.
@@ -438,43 +616,280 @@ def make_json_to_dataset(creators, domain, granularity_translations, group_title
     return json_to_dataset
 
 
-def retrieve_datasets(source_headers, source_site_url, api_key = None):
+def close_markdown_cache():
+    global markdown_cache
+    if markdown_cache is not None:
+        log.info(u'Markdown cache: {}'.format(markdown_cache.statistics_to_str()))
+        markdown_cache = None
+
+
+def convert_and_check_html_batch(values):
+    """Convert HTML fragments with convert_html_batch, checking some of them against conversions alone.
+
+    Return the Markdown of each fragment (or None) & the indexes of the fragments whose Markdown has been checked. The
+    checked fragments are the first & the last ones of the batch (and evenly spaced ones between them, depending on
+    batch_check_size), so that runs are reproducible. On the first mismatch, batching is disabled: the Markdown of the
+    batch is discarded & every following fragment is converted alone (by html_to_markdown).
+    """
+    global batching_enabled
+    if not batching_enabled:
+        return [None] * len(values), set()
+    markdowns = convert_html_batch(values)
+    converted_indexes = [
+        index
+        for index, markdown in enumerate(markdowns)
+        if markdown is not None
+        ]
+    checked_indexes = set(
+        converted_indexes[check_index * (len(converted_indexes) - 1) // max(1, batch_check_size - 1)]
+        for check_index in range(min(batch_check_size, len(converted_indexes)))
+        )
+    for index in sorted(checked_indexes):
+        markdown = run_pandoc(values[index])
+        if markdowns[index] != markdown:
+            if batching_enabled:
+                log.warning(u'Batch conversion of pandoc differs from conversion alone, disabling batches:'
+                    u' {!r} != {!r}'.format(markdowns[index], markdown))
+                batching_enabled = False
+            return [
+                markdown if checked_index == index else None
+                for checked_index in range(len(values))
+                ], set([index])
+    return markdowns, checked_indexes
+
+
+def convert_html_batch(values):
+    """Convert HTML fragments to Markdown with a single pandoc process and return the Markdown of each fragment.
+
+    The fragments are separated by paragraphs containing a random token. The Markdown of a fragment is None when it
+    can't be extracted from pandoc output (it must then be converted alone).
+    """
+    separator = u'pandocbatchseparator{}'.format(uuid.uuid4().hex)
+    html = u'<p>{}</p>\n'.format(separator).join([u''] + values + [u''])
+    markdown = run_pandoc(html)
+    # Output is: separator, Markdown of first fragment, separator, ..., Markdown of last fragment, separator.
+    parts = re.split(ur'(?m)^{}$'.format(separator), markdown)
+    if len(parts) != len(values) + 2 or parts[0].strip() or parts[-1].strip():
+        log.warning(u'Unexpected output of pandoc for a batch of {} HTML fragments'.format(len(values)))
+        return [None] * len(values)
+    return [
+        # Pandoc ends the Markdown of a document with a newline. Empty outputs are ambiguous: convert them alone.
+        part.strip(u'\n') + u'\n' if part.strip(u'\n') else None
+        for part in parts[1:-1]
+        ]
+
+
+def get_pandoc_version():
+    """Return the version of pandoc (& its options), used to key persistent conversions."""
+    global pandoc_version
+    if pandoc_version is None:
+        process = subprocess.Popen(pandoc_command[:1] + ['--version'], stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        pandoc_version = u'{} ({})'.format(stdout.splitlines()[0].decode('utf-8') if stdout else u'',
+            u' '.join(pandoc_command[1:]))
+    return pandoc_version
+
+
+def html_to_markdown(value, state = None):
+    if value is None:
+        return value, None
+    markdown = markdown_by_html.get(value)
+    if markdown is None and markdown_cache is not None:
+        markdown = markdown_cache.get(value)
+    if markdown is None:
+        markdown = run_pandoc(value)
+        if markdown_cache is not None:
+            markdown_cache.put(value, markdown)
+    markdown_by_html[value] = markdown
+    return markdown, None
+
+
+def is_batchable(value):
+    checker = BatchabilityChecker()
+    try:
+        checker.feed(value)
+        checker.close()
+    except HTMLParser.HTMLParseError:
+        return False
+    return checker.batchable and not checker.open_tags and bool(value.strip())
+
+
+def iter_datasets_pages(source_headers, source_site_url, api_key = None, page_size = 1000, thread_count = 4):
+    """Generate the pages of datasets of an OpenDataSoft site, in their order, while the next pages are retrieved.
+
+    The first page gives the number of datasets (nhits). The following pages are then retrieved using up to
+    thread_count concurrent requests, ahead of the consumer of the pages. The datasets published meanwhile are
+    retrieved sequentially afterwards, until an empty page.
+    """
     # Retrieve list of packages in source.
     log.info(u'Retrieving list of source packages')
-    datasets = []
+    response_dict = retrieve_datasets_page(source_headers, source_site_url, 0, page_size, api_key = api_key)
+    page = response_dict['datasets']
+    if not page:
+        return
+    datasets_count = len(page)
+    nhits = response_dict['nhits']
+    yield page
+    if nhits is not None:
+        # The site may return less datasets than asked for.
+        rows = datasets_count
+        for response_dict in helpers.iter_parallel_map(
+                lambda start: retrieve_datasets_page(source_headers, source_site_url, start, rows, api_key = api_key),
+                range(rows, nhits, rows),
+                thread_count = thread_count,
+                ):
+            page = response_dict['datasets']
+            datasets_count += len(page)
+            yield page
     while True:
-        request = urllib2.Request(
-            urlparse.urljoin(
-                source_site_url,
-#                u'api/datasets/1.0/search/?{}start={}&interopmetas=true'.format(
-                u'api/datasets/1.0/search/?{}start={}'.format(
-                    u'apikey={}&'.format(api_key) if api_key is not None else u'',
-                    len(datasets),
-                    ),
+        page = retrieve_datasets_page(source_headers, source_site_url, datasets_count, page_size,
+            api_key = api_key)['datasets']
+        if not page:
+            break
+        datasets_count += len(page)
+        yield page
+
+
+def make_json_to_dataset(creators, domain, granularity_translations, group_title_translations, license_id_by_license,
+        temporals, default_publisher = None):
+    """Return the converter from the JSON of an OpenDataSoft dataset to a dataset, built once per configuration.
+
+    The (hashable) configuration of the converter is kept in its config attribute.
+    """
+    config = to_hashable((creators, domain, granularity_translations, group_title_translations, license_id_by_license,
+        temporals, default_publisher))
+    json_to_dataset = json_to_dataset_by_config.get(config)
+    if json_to_dataset is None:
+        json_to_dataset = json_to_dataset_by_config[config] = build_json_to_dataset(creators, domain,
+            granularity_translations, group_title_translations, license_id_by_license, temporals,
+            default_publisher = default_publisher)
+        json_to_dataset.config = config
+    return json_to_dataset
+
+
+def open_markdown_cache(state_dir):
+    """Keep the conversions of html_to_markdown in state directory (when there is one), to reuse them between runs."""
+    global markdown_cache
+    if state_dir is not None:
+        markdown_cache = markdowncaches.MarkdownCache(os.path.join(state_dir, 'markdown-cache'), get_pandoc_version())
+
+
+def prepare_datasets_conversion(datasets, datasets_index = None, batch_size = 50, processes_count = 4):
+    """Convert in batches the descriptions of the datasets that will be converted (ie not reused from index).
+
+    The conversions prepared for previous datasets are forgotten (but kept in markdown_cache, when it is open), so that
+    memory is not held by the descriptions of every page of datasets.
+    """
+    markdown_by_html.clear()
+    prepare_html_to_markdown(
+        [
+            entry[u'metas'][u'description']
+            for entry in datasets
+            if isinstance((entry.get(u'metas') or {}).get(u'description'), basestring)
+                and (datasets_index is None or not datasets_index.is_unchanged(entry))
+            ],
+        batch_size = batch_size,
+        processes_count = processes_count,
+        )
+
+
+def prepare_html_to_markdown(values, batch_size = 50, processes_count = 4):
+    """Convert HTML fragments in batches (using up to processes_count pandoc processes) & cache their Markdown.
+
+    This avoids starting a pandoc process for each call of html_to_markdown. The fragments that can't be converted in
+    a batch (without changing their Markdown) are left to html_to_markdown. Each batch is checked on some of its
+    fragments (see convert_and_check_html_batch) & only the Markdown of the checked fragments is put in markdown_cache.
+    """
+    if not batching_enabled:
+        return
+    values = set(
+        value
+        for value in values
+        if value not in markdown_by_html
+        )
+    if markdown_cache is not None:
+        for value in list(values):
+            markdown = markdown_cache.get(value)
+            if markdown is not None:
+                markdown_by_html[value] = markdown
+                values.discard(value)
+    values = sorted(
+        value
+        for value in values
+        if is_batchable(value)
+        )
+    batches = [
+        values[index:index + batch_size]
+        for index in range(0, len(values), batch_size)
+        ]
+    for batch, (markdowns, checked_indexes) in zip(batches, helpers.parallel_map(convert_and_check_html_batch,
+            batches, thread_count = processes_count)):
+        for index, (value, markdown) in enumerate(zip(batch, markdowns)):
+            if markdown is None:
+                continue
+            if index in checked_indexes:
+                # Markdown is the same as when converted alone: keep it for next runs too.
+                markdown_by_html[value] = markdown
+                if markdown_cache is not None:
+                    markdown_cache.put(value, markdown)
+            elif batching_enabled:
+                # Unless a batch differed, keep the Markdown of the other fragments for this run only.
+                markdown_by_html[value] = markdown
+    log.info(u'Converted {} HTML fragments to Markdown in {} batches'.format(len(values), len(batches)))
+
+
+def retrieve_datasets_page(source_headers, source_site_url, start, rows, api_key = None):
+    request = urllib2.Request(
+        urlparse.urljoin(
+            source_site_url,
+#            u'api/datasets/1.0/search/?{}start={}&rows={}&interopmetas=true'.format(
+            u'api/datasets/1.0/search/?{}start={}&rows={}'.format(
+                u'apikey={}&'.format(api_key) if api_key is not None else u'',
+                start,
+                rows,
                 ),
-            headers = source_headers)
-        response = urllib2.urlopen(request)
-        response_dict = conv.check(conv.pipe(
-            conv.make_input_to_json(),
-            conv.test_isinstance(dict),
-            conv.struct(
-                dict(
-                    datasets = conv.pipe(
-                        conv.test_isinstance(list),
-                        conv.uniform_sequence(
-                            conv.pipe(
-                                conv.test_isinstance(dict),
-                                conv.not_none,
-                                ),
+            ),
+        headers = source_headers)
+    response = urllib2.urlopen(request)
+    return conv.check(conv.pipe(
+        conv.make_input_to_json(),
+        conv.test_isinstance(dict),
+        conv.struct(
+            dict(
+                datasets = conv.pipe(
+                    conv.test_isinstance(list),
+                    conv.uniform_sequence(
+                        conv.pipe(
+                            conv.test_isinstance(dict),
+                            conv.not_none,
                             ),
-                        conv.not_none,
                         ),
+                    conv.not_none,
                     ),
-                default = conv.noop,
+                nhits = conv.test_isinstance(int),
                 ),
-            conv.not_none,
-            ))(response.read(), state = conv.default_state)
-        if not response_dict['datasets']:
-            break
-        datasets.extend(response_dict['datasets'])
-    return datasets
+            default = conv.noop,
+            ),
+        conv.not_none,
+        ))(response.read(), state = conv.default_state)
+
+
+def run_pandoc(html):
+    process = subprocess.Popen(pandoc_command, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+    stdout, stderr = process.communicate(html.encode('utf-8'))
+    return stdout.decode('utf-8')
+
+
+def to_hashable(value):
+    """Convert a configuration made of dicts, lists, sets & scalars to an equivalent hashable value."""
+    if isinstance(value, dict):
+        return (dict, tuple(sorted(
+            (to_hashable(key), to_hashable(item))
+            for key, item in value.iteritems()
+            )))
+    if isinstance(value, (frozenset, set)):
+        return (set, tuple(sorted(to_hashable(item) for item in value)))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(to_hashable(item) for item in value))
+    return value
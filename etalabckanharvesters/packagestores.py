@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Stores of the data harvested for each package, kept until the update of target
+
+By default, harvested packages are kept in memory. For very large harvests, they can be kept on disk, in a temporary
+SQLite database or shelve file, so that a harvest runs in bounded memory. Every store is a mapping (by package name)
+and can be shared between threads.
+
+Note: A value retrieved from a disk store is a copy: modifying it doesn't modify the store.
+"""
+
+
+import atexit
+import collections
+import cPickle
+import os
+import shelve
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+
+stores_kind = ('memory', 'shelve', 'sqlite')
+
+
+class ShelveStore(collections.MutableMapping):
+    """Store kept in a temporary shelve file"""
+    dir_path = None
+    lock = None
+    shelf = None
+
+    def __init__(self):
+        self.dir_path = tempfile.mkdtemp(prefix = 'harvester-store-')
+        self.lock = threading.Lock()
+        self.shelf = shelve.open(os.path.join(self.dir_path, 'store'), flag = 'n', protocol = cPickle.HIGHEST_PROTOCOL)
+        atexit.register(self.close)
+
+    def __contains__(self, key):
+        # Don't unpickle the value, like MutableMapping.__contains__ would.
+        with self.lock:
+            return key.encode('utf-8') in self.shelf
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.shelf[key.encode('utf-8')]
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.shelf[key.encode('utf-8')]
+
+    def __iter__(self):
+        with self.lock:
+            keys = self.shelf.keys()
+        return (key.decode('utf-8') for key in keys)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.shelf)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.shelf[key.encode('utf-8')] = value
+
+    def close(self):
+        with self.lock:
+            if self.shelf is not None:
+                self.shelf.close()
+                self.shelf = None
+                shutil.rmtree(self.dir_path, ignore_errors = True)
+
+
+class SqliteStore(collections.MutableMapping):
+    """Store kept in a temporary SQLite database (deleted by SQLite when closed)"""
+    connection = None
+    lock = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect('', check_same_thread = False)
+        self.connection.execute('CREATE TABLE store (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM store WHERE key = ?', (key,)).fetchone() is not None
+
+    def __delitem__(self, key):
+        with self.lock:
+            if self.connection.execute('DELETE FROM store WHERE key = ?', (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return cPickle.loads(str(row[0]))
+
+    def __iter__(self):
+        with self.lock:
+            keys = [key for key, in self.connection.execute('SELECT key FROM store')]
+        return iter(keys)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT count(*) FROM store').fetchone()[0]
+
+    def __setitem__(self, key, value):
+        value = sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def new_store(kind = 'memory'):
+    """Return a new empty store of the given kind."""
+    assert kind in stores_kind, kind
+    if kind == 'shelve':
+        return ShelveStore()
+    if kind == 'sqlite':
+        return SqliteStore()
+    return {}
@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Etalab-CKAN-Harvesters -- Harvesters for Etalab's CKAN
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/etalab-ckan-harvesters
+#
+# This file is part of Etalab-CKAN-Harvesters.
+#
+# Etalab-CKAN-Harvesters is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Etalab-CKAN-Harvesters is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Local snapshot of the state of a target CKAN, stored in a SQLite database
+
+For each package upserted by a harvester, the snapshot keeps the fingerprint of the harvested package & of the
+package returned by CKAN, and the fingerprint of its related links. It allows a harvester to skip the packages that
+didn't change since its previous run, neither in source nor in target.
+
+The snapshot also keeps the listing of the packages of each organization (ID, title, fingerprint & modification time
+of each package), so that the next run only retrieves the packages modified in target since then.
+"""
+
+
+import os
+import sqlite3
+import threading
+
+
+class TargetSnapshot(object):
+    """Snapshot of a target CKAN, for a harvester. It can be shared between threads.
+
+    Each harvester has its own database file, and every change is committed at once (with a busy timeout), so that
+    several harvesters (or runs) using the same state directory don't lock each other.
+    """
+    busy_timeout = 30.0  # Time (in seconds) to wait for a database locked by another process
+    connection = None
+    fingerprint_by_package_name = None
+    lock = None
+    related_fingerprint_by_package_name = None
+    site_url = None
+    target_fingerprint_by_package_name = None
+
+    def __init__(self, state_dir, site_url, harvester_name):
+        dir_path = os.path.join(state_dir, 'snapshots')
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self.site_url = site_url
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(dir_path, u'{}.sqlite'.format(harvester_name)),
+            check_same_thread = False, timeout = self.busy_timeout)
+        # Let readers & the writer work concurrently, and commit without waiting for a full sync of the disk.
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        with self.connection:
+            self.connection.execute('''\
+                CREATE TABLE IF NOT EXISTS packages (
+                    site_url TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    target_fingerprint TEXT NOT NULL,
+                    PRIMARY KEY (site_url, name)
+                    )
+                ''')
+            self.connection.execute('''\
+                CREATE TABLE IF NOT EXISTS listed_packages (
+                    site_url TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    organization_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    metadata_modified TEXT NOT NULL,
+                    PRIMARY KEY (site_url, name)
+                    )
+                ''')
+            self.connection.execute('''\
+                CREATE TABLE IF NOT EXISTS related (
+                    site_url TEXT NOT NULL,
+                    package_name TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    PRIMARY KEY (site_url, package_name)
+                    )
+                ''')
+
+        self.fingerprint_by_package_name = {}
+        self.target_fingerprint_by_package_name = {}
+        for name, package_fingerprint, target_fingerprint in self.connection.execute(
+                'SELECT name, fingerprint, target_fingerprint FROM packages WHERE site_url = ?', (site_url,)):
+            self.fingerprint_by_package_name[name] = package_fingerprint
+            self.target_fingerprint_by_package_name[name] = target_fingerprint
+        self.related_fingerprint_by_package_name = dict(self.connection.execute(
+            'SELECT package_name, fingerprint FROM related WHERE site_url = ?', (site_url,)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def delete_package(self, name):
+        with self.lock, self.connection:
+            self.fingerprint_by_package_name.pop(name, None)
+            self.target_fingerprint_by_package_name.pop(name, None)
+            self.related_fingerprint_by_package_name.pop(name, None)
+            self.connection.execute('DELETE FROM packages WHERE site_url = ? AND name = ?', (self.site_url, name))
+            self.connection.execute('DELETE FROM listed_packages WHERE site_url = ? AND name = ?',
+                (self.site_url, name))
+            self.connection.execute('DELETE FROM related WHERE site_url = ? AND package_name = ?',
+                (self.site_url, name))
+
+    def get_organization_listing(self, organization_id):
+        """Return the infos (ID, title, fingerprint & modification time) of the packages of an organization, by name,
+        as they were at the end of its previous listing. An organization never listed has no packages.
+        """
+        with self.lock:
+            return dict(
+                (name, dict(
+                    fingerprint = package_fingerprint,
+                    id = id,
+                    metadata_modified = metadata_modified,
+                    title = title,
+                    ))
+                for name, id, title, package_fingerprint, metadata_modified in self.connection.execute(
+                    '''SELECT name, id, title, fingerprint, metadata_modified FROM listed_packages
+                    WHERE site_url = ? AND organization_id = ?''', (self.site_url, organization_id))
+                )
+
+    def get_related_fingerprint(self, package_name):
+        with self.lock:
+            return self.related_fingerprint_by_package_name.get(package_name)
+
+    def is_package_unchanged(self, name, fingerprint, target_fingerprint):
+        """Return whether both a harvested package and the package currently in target have the same fingerprints as
+        at the previous upsert of the package.
+        """
+        with self.lock:
+            return self.fingerprint_by_package_name.get(name) == fingerprint \
+                and self.target_fingerprint_by_package_name.get(name) == target_fingerprint
+
+    def set_organization_listing(self, organization_id, infos_by_name):
+        """Replace the listing of the packages of an organization (see get_organization_listing)."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM listed_packages WHERE site_url = ? AND organization_id = ?',
+                (self.site_url, organization_id))
+            self.connection.executemany(
+                '''INSERT OR REPLACE INTO listed_packages
+                (site_url, name, organization_id, id, title, fingerprint, metadata_modified)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (
+                    (self.site_url, name, organization_id, infos['id'], infos['title'], infos['fingerprint'],
+                        infos['metadata_modified'])
+                    for name, infos in infos_by_name.iteritems()
+                    ))
+
+    def set_package(self, name, fingerprint, target_fingerprint):
+        """Store the fingerprint of a harvested package and of the package returned by CKAN after its upsert."""
+        with self.lock, self.connection:
+            self.fingerprint_by_package_name[name] = fingerprint
+            self.target_fingerprint_by_package_name[name] = target_fingerprint
+            self.connection.execute(
+                'INSERT OR REPLACE INTO packages (site_url, name, fingerprint, target_fingerprint) VALUES (?, ?, ?, ?)',
+                (self.site_url, name, fingerprint, target_fingerprint))
+
+    def set_related_fingerprint(self, package_name, fingerprint):
+        """Store the fingerprint of the related links of a package, once they have been upserted."""
+        with self.lock, self.connection:
+            self.related_fingerprint_by_package_name[package_name] = fingerprint
+            self.connection.execute(
+                'INSERT OR REPLACE INTO related (site_url, package_name, fingerprint) VALUES (?, ?, ?)',
+                (self.site_url, package_name, fingerprint))